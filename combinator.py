@@ -1,9 +1,13 @@
-from copy import deepcopy
-from sys import setrecursionlimit
+from copy import deepcopy, copy
+import os
+from collections import OrderedDict
 import numpy as np
 from leap_ec import Individual, context
 from leap_ec import ops, util
-from leap_ec.decoder import IdentityDecoder
+from leap_ec.decoder import IdentityDecoder, Decoder
+from leap_ec.problem import ScalarProblem
+from leap_ec.representation import Representation
+from leap_ec.int_rep.ops import mutate_randint
 
 # from leap_ec.real_rep.problems import SpheroidProblem, plot_2d_problem
 # from leap_ec.real_rep.ops import mutate_gaussian
@@ -12,56 +16,60 @@ from leap_ec.int_rep.initializers import create_int_vector
 
 from leap_ec.algorithm import generational_ea
 from leap_ec.probe import CartesianPhenotypePlotProbe, BestSoFarProbe, FitnessPlotProbe
-
-setrecursionlimit(5000)
+from random_stream import RandomStream
+from evolution import Evolution, start_pool as start_worker_pool
 
 class Combinator:
-    RECURSION_LIMIT = 100
+    # A combinator, applied to the terms in `args`. Calling a combinator
+    # applies it to more terms and reduces the result to normal form, see
+    # `Reducer`.
+    #
+    # Lambdas are strict: their arguments are reduced to normal form before
+    # the function is called. Every other combinator is lazy.
+    strict = False
 
     def __init__(self, *args):
         self.args = list(args)
-        self.depth = 0
+        self._hash = None
 
     def __getitem__(self, index):
         return self.args[index]
 
     def __setitem__(self, index, value):
         self.args[index] = value
-
-    def set_depth(self, depth):
-        self.depth = depth
+        self._hash = None
 
     def num_required_args(self):
         raise NotImplementedError
 
-    def apply(self, args, depth=0):
+    def apply(self, args):
+        # Returns the term the combinator rewrites to when it is applied to
+        # `args`. The arguments are graph nodes, and may be shared by the
+        # result.
         raise NotImplementedError
 
     def clone(self):
         return deepcopy(self)
 
-    def __call__(self, *args):
-        if self.depth > self.RECURSION_LIMIT:
-            raise RecursionError("Maximum recursion depth exceeded for Combinator", self.__class__.__name__, self.args, self.depth)
+    def with_args(self, args):
+        # The same combinator, applied to other terms.
+        if len(args) == 0 and len(self.args) == 0:
+            return self
+        result = copy(self)
+        result.args = list(args)
+        result._hash = None
+        return result
 
-        result = self.clone()
+    def key(self):
+        # Combinators without arguments with equal keys are interned to the
+        # same leaf, see `TermTable`.
+        return (self.__class__,)
 
+    def __call__(self, *args):
         for arg in args:
             if not isinstance(arg, Combinator):
                 raise TypeError(f"Expected Combinator, got {type(arg)}")
-            result.args.append(arg.clone())
-
-        if len(result.args) < result.num_required_args():
-            return result
-
-        result.set_depth(result.depth + 1)
-        for arg in result.args:
-            arg.set_depth(result.depth + 1)
-
-        if len(result.args) == result.num_required_args():
-            return result.clone().apply(result.args)
-        else:
-            return result.clone().apply(result.args[:result.num_required_args()]).clone()(*result.args[result.num_required_args():])
+        return Reducer().evaluate(self, *args)
 
     def __repr__(self):
         return f"{self.__class__.__name__}({', '.join(map(repr, self.args))})"
@@ -70,11 +78,355 @@ class Combinator:
         return self.__repr__()
 
     def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.args == other.args
+        return self is other or (self.__class__ == other.__class__ and self.args == other.args)
     
     def __hash__(self):
-        return hash((self.__class__, tuple(self.args)))
+        # Interned combinators are never changed, so their hash is only
+        # computed once.
+        if self._hash is None:
+            self._hash = hash((self.__class__, tuple(self.args)))
+        return self._hash
+
+class App:
+    # An application node of a term graph. The leaves of the graph are
+    # combinators without arguments. Nodes are shared between the terms
+    # they are part of, so when a node is reduced, it is updated in place
+    # to forward to its result, and every term sharing it sees the result.
+    __slots__ = ('function', 'argument', 'forward')
+
+    def __init__(self, function, argument):
+        self.function = function
+        self.argument = argument
+        self.forward = None
+
+class LRUCache:
+    # A least recently used cache. Callers keep whatever a key refers to
+    # alive in its value.
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+class TermTable:
+    # A hash-consing table for terms. Equal leaves, application nodes and
+    # combinators in normal form are interned to the same object, so equal
+    # terms are the same object, and whatever is known about one of them,
+    # like its reductions, is known about all of them. Nodes are keyed by
+    # the identities of their parts, which the entries keep alive.
+    #
+    # The table is bounded. A term that falls out of it stays valid, it is
+    # just no longer shared with new equal terms.
+    def __init__(self, size):
+        self.terms = LRUCache(size)
+
+    def leaf(self, combinator):
+        try:
+            key = combinator.key()
+            hash(key)
+        except TypeError:
+            # Leaves with unhashable values are only equal to themselves.
+            key = (combinator.__class__, id(combinator))
+        entry = self.terms.get(key)
+        if entry is None:
+            entry = self.terms.put(key, (combinator, combinator))
+        return entry[-1]
+
+    def app(self, function, argument):
+        key = (App, id(function), id(argument))
+        entry = self.terms.get(key)
+        if entry is None:
+            entry = self.terms.put(key, (function, argument, App(function, argument)))
+        return entry[-1]
+
+    def combinator(self, head, args):
+        # `head` is an interned leaf and `args` are interned combinators.
+        key = (Combinator, id(head)) + tuple(map(id, args))
+        entry = self.terms.get(key)
+        if entry is None:
+            result = head.with_args(args)
+            try:
+                hash(result)
+            except TypeError:
+                pass
+            entry = self.terms.put(key, (head, args, result))
+        return entry[-1]
+
+    def __len__(self):
+        return len(self.terms)
+
+TERMS = TermTable(1 << 18)
+
+def app(function, argument):
+    # The interned application of a node to another.
+    return TERMS.app(function, argument)
+
+class Diverged:
+    # The result of a term that did not reach normal form within the budget
+    # of its reducer, because it took more than `step_limit` steps, grew past
+    # `size_limit` nodes, or a rewrite would tie it into a cycle. Divergence
+    # is cached like a normal form, and holds for any smaller budget.
+    def __init__(self, reason, steps, size, step_limit=float('inf'), size_limit=float('inf')):
+        self.reason = reason
+        self.steps = steps
+        self.size = size
+        self.step_limit = step_limit
+        self.size_limit = size_limit
+
+    def holds_for(self, step_limit, size_limit):
+        return self.step_limit >= step_limit and self.size_limit >= size_limit
 
+    def __repr__(self):
+        return f"Diverged({self.reason!r}, steps={self.steps}, size={self.size})"
+
+class OutOfBudget(Exception):
+    # Stops the reduction loop of a `Reducer` with a `Diverged` result.
+    def __init__(self, diverged):
+        super().__init__(diverged)
+        self.diverged = diverged
+
+# The normal forms of interned terms, by the identity of the term.
+NORMAL_FORMS = LRUCache(1 << 16)
+
+def follow(node):
+    # Skips the indirections of reduced nodes.
+    while type(node) is App and node.forward is not None:
+        node = node.forward
+    return node
+
+def unwind(node):
+    # Returns the head of a term and the nodes it is applied to, in order.
+    args = []
+    node = follow(node)
+    while type(node) is App:
+        args.append(node.argument)
+        node = follow(node.function)
+    args.reverse()
+    return node, args
+
+class Reducer:
+    # Reduces term graphs by walking down the spine of the term, without
+    # recursion, and rewriting the leftmost outermost redex until the head
+    # of the term has fewer arguments than it requires. Every rewrite is a
+    # step, and every node the reducer walks down to or queues to normalize
+    # is part of the size of the term. Nodes are shared with other terms, so
+    # the size is counted by the reducer, not by the nodes it builds. A term
+    # that takes more than `step_limit` steps, or grows past `size_limit`
+    # nodes, is stopped and diverges.
+    STEP_LIMIT = 10000
+    SIZE_LIMIT = 20000
+
+    def __init__(self, step_limit=STEP_LIMIT, size_limit=SIZE_LIMIT):
+        self.step_limit = step_limit
+        self.size_limit = size_limit
+        self.steps = 0
+        self.size = 0
+        # The nodes known to be in normal form, by id.
+        self.normal = {}
+
+    def evaluate(self, combinator, *args):
+        # Applies the combinator to the arguments, and returns the normal
+        # form. A term that diverges raises a RecursionError.
+        node = self.to_graph(combinator)
+        for arg in args:
+            node = app(node, self.to_graph(arg))
+        result = self.reduce(node)
+        if type(result) is Diverged:
+            raise RecursionError(f"Term diverged: {result}")
+        return result
+
+    def reduce(self, node):
+        # The combinator of the normal form of a term graph, or `Diverged`.
+        result = self.normalize(node)
+        if type(result) is Diverged:
+            return result
+        return self.read_back(result)
+
+    def to_graph(self, combinator):
+        # The graph of a combinator and the terms it is applied to.
+        nodes = {}
+        stack = [combinator]
+        while stack:
+            term = stack[-1]
+            if id(term) in nodes:
+                stack.pop()
+                continue
+            missing = [arg for arg in term.args if id(arg) not in nodes]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            node = TERMS.leaf(term.with_args([]))
+            for arg in term.args:
+                node = app(node, nodes[id(arg)])
+            nodes[id(term)] = node
+        return nodes[id(combinator)]
+
+    def read_back(self, node):
+        # The combinator of a term graph in normal form. Shared nodes become
+        # shared combinators.
+        terms = {}
+        stack = [follow(node)]
+        while stack:
+            current = stack[-1]
+            if id(current) in terms:
+                stack.pop()
+                continue
+            head, args = unwind(current)
+            args = [follow(arg) for arg in args]
+            missing = [arg for arg in args if id(arg) not in terms]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            terms[id(current)] = TERMS.combinator(head, [terms[id(arg)] for arg in args])
+        return terms[id(follow(node))]
+
+    def step(self):
+        self.steps += 1
+        if self.steps > self.step_limit:
+            self.diverge('steps')
+
+    def visit(self, count=1):
+        self.size += count
+        if self.size > self.size_limit:
+            self.diverge('size')
+
+    def diverge(self, reason, limited=True):
+        if limited:
+            diverged = Diverged(reason, self.steps, self.size, self.step_limit, self.size_limit)
+        else:
+            diverged = Diverged(reason, self.steps, self.size)
+        raise OutOfBudget(diverged)
+
+    def whnf(self, node):
+        # Reduces the term until its head is not applied to enough arguments
+        # to be rewritten, and returns it. A lambda is only called once its
+        # arguments are in normal form. If they are not, the term is left as
+        # it is, and the arguments are returned in a `Pending` instead.
+        spine = []
+        head = follow(node)
+        while True:
+            while type(head) is App:
+                spine.append(head)
+                self.visit()
+                head = follow(head.function)
+            arity = head.num_required_args()
+            if len(spine) < arity:
+                return spine[0] if spine else head
+            args = [follow(spine[-1 - i].argument) for i in range(arity)]
+            if head.strict:
+                pending = [arg for arg in args if id(arg) not in self.normal]
+                if pending:
+                    return Pending(pending)
+            self.step()
+            redex = spine[-arity] if arity > 0 else head
+            del spine[len(spine) - arity:]
+            if head.strict:
+                result = self.to_graph(head.apply([self.read_back(arg) for arg in args]))
+            else:
+                result = head.apply(args)
+            head = follow(result)
+            self.check_cycle(head, redex if type(redex) is App else spine[-1] if spine else None)
+            if type(redex) is App:
+                redex.forward = head
+            elif spine:
+                spine[-1].function = head
+            else:
+                node = head
+
+    def check_cycle(self, result, rewritten):
+        # Equal terms are the same node, so the result of a rewrite can
+        # contain the node it replaces. If that node is on the spine of the
+        # result, the rewrite would tie the spine into a cycle, and the term
+        # would be rewritten forever, whatever the budget.
+        node = result
+        while True:
+            if node is rewritten:
+                self.diverge('cycle', limited=False)
+            if type(node) is not App:
+                return
+            node = follow(node.function)
+
+    def normalize(self, node):
+        # Reduces the term and every term it is applied to, with a stack of
+        # terms to normalize instead of recursion. Returns the normal form,
+        # or `Diverged` if the budget runs out first. Normal forms are cached
+        # across reducers, as is running out of budget on the whole term.
+        # A reducer can normalize several terms, so a term that runs out of
+        # budget is cached with the budget that was left when it started,
+        # not with the limits of the reducer.
+        steps, size = self.steps, self.size
+        try:
+            return self.normalize_terms(node)
+        except OutOfBudget as stop:
+            diverged = stop.diverged
+            if diverged.step_limit != float('inf') or diverged.size_limit != float('inf'):
+                diverged = Diverged(diverged.reason, diverged.steps - steps, diverged.size - size,
+                                    self.step_limit - steps, self.size_limit - size)
+            # A divergence found in the cache holds for a larger budget than
+            # this one, and is kept.
+            cached = NORMAL_FORMS.get(id(node))
+            if cached is None or not cached[1].holds_for(diverged.step_limit, diverged.size_limit):
+                NORMAL_FORMS.put(id(node), (node, diverged))
+            return stop.diverged
+
+    def normalize_terms(self, node):
+        results = {}
+        tasks = [node]
+        while tasks:
+            current = tasks[-1]
+            cached = NORMAL_FORMS.get(id(current))
+            if cached is not None:
+                result = cached[1]
+                if type(result) is Diverged:
+                    if result.holds_for(self.step_limit - self.steps, self.size_limit - self.size):
+                        raise OutOfBudget(result)
+                else:
+                    tasks.pop()
+                    self.normal[id(result)] = result
+                    results[id(current)] = result
+                    continue
+            result = self.whnf(current)
+            if type(result) is Pending:
+                tasks.extend(result.args)
+                self.visit(len(result.args))
+                continue
+            pending = []
+            spine = result
+            while type(spine) is App:
+                spine.argument = follow(spine.argument)
+                if id(spine.argument) not in self.normal:
+                    pending.append(spine.argument)
+                spine = follow(spine.function)
+            if pending:
+                tasks.extend(pending)
+                self.visit(len(pending))
+                continue
+            tasks.pop()
+            self.normal[id(result)] = result
+            self.normal[id(follow(current))] = result
+            results[id(current)] = result
+            NORMAL_FORMS.put(id(current), (current, result))
+        return results[id(node)]
+
+class Pending:
+    # The arguments a lambda is waiting for, see `Reducer.whnf`.
+    def __init__(self, args):
+        self.args = args
 
 class Data(Combinator):
     def __init__(self, value):
@@ -212,6 +564,9 @@ class Data(Combinator):
         else:
             return self.value >= other
 
+    def key(self):
+        return (self.__class__, self.value)
+
     def __repr__(self):
         return f"Data({self.value})"
     
@@ -234,12 +589,18 @@ class Lambda(Combinator):
         result.num_args = self.num_args
         return result
 
+    strict = True
+
     def num_required_args(self):
         return self.num_args
 
     def apply(self, args):
+        # The arguments are combinators in normal form.
         return self.function(*args)
 
+    def key(self):
+        return (self.__class__, self.function, self.num_args)
+
     def __repr__(self):
         return f"Lambda({self.function.__name__})"
 
@@ -255,11 +616,9 @@ class S(Combinator):
         return 3
 
     def apply(self, args):
-        x = args[0]
-        y = args[1]
-        z = args[2]
-        z2 = z.clone()
-        return x(z)(y(z2))
+        # z is shared, not copied, so it is reduced at most once.
+        x, y, z = args
+        return app(app(x, z), app(y, z))
 
 class K(Combinator):
     def num_required_args(self):
@@ -283,6 +642,11 @@ i = I()
 assert s(k, i, i) == i
 assert s(k)(i)(k(i)(s))(i) == i
 assert k(k, s, i) == k(i)
+# A term without a normal form diverges within the budget of its reducer,
+# and a term that a rewrite would tie into a cycle diverges whatever the
+# budget.
+assert Reducer(step_limit=200).reduce(Reducer().to_graph(S(i, i, S(i, S(s))))).reason == 'steps'
+assert Reducer().reduce(Reducer().to_graph(S(i, i, S(i, i)))).reason == 'cycle'
 
 
 
@@ -318,7 +682,20 @@ class Point:
 assert s(k, i, i)(Lambda(lambda point: Data(point.value.shift_by(1, 0))))(Data(Point(5, 6))) == Data(Point(6, 6))
 
 
-import random
+# Set this to repeat a run.
+SEED = None
+RNG = RandomStream.from_seed(SEED)
+
+# The combinators of random genes.
+BASE_COMBINATORS = [S(), K(), I()]
+
+def pick(sequence, draw):
+    # The item of `sequence` that a uniform draw from [0, 1) falls on, and
+    # what is left of the draw, which is again uniform. This lets one draw
+    # of a bulk batch make a nested random choice.
+    draw *= len(sequence)
+    index = min(int(draw), len(sequence) - 1)
+    return sequence[index], draw - index
 
 # We are going to evolve SKI combinator programs.
 # This will be the representation of a program.
@@ -332,14 +709,13 @@ class CombinatorGene:
     def clone(self):
         return CombinatorGene(self.combinator.clone())
 
-    def random(combinator_set=[S(), K(), I()]):
-        return CombinatorGene(random.choice(combinator_set))
+    def random(combinator_set=[S(), K(), I()], rng=RNG):
+        return CombinatorGene(rng.choice(combinator_set))
 
-    def mutate(self, combinator_set=[S(), K(), I()]):
-        result = random.random()
+    def mutate(self, combinator_set, draw):
         # Randomly mutate into another combinator or into an application.
-        if result < 0.5:
-            return CombinatorGene.random()
+        if draw < 0.5:
+            return CombinatorGene(pick(BASE_COMBINATORS, 2 * draw)[0])
         else:
             return ApplicationGene()
 
@@ -353,8 +729,8 @@ class ApplicationGene:
     def clone(self):
         return ApplicationGene()
 
-    def mutate(self, combinator_set=[S(), K(), I()]):
-        return CombinatorGene(random.choice(combinator_set))
+    def mutate(self, combinator_set, draw):
+        return CombinatorGene(pick(combinator_set, draw)[0])
 
     def __hash__(self):
         return hash("Apply")
@@ -366,22 +742,56 @@ class NothingGene:
     def clone(self):
         return NothingGene()
 
-    def mutate(self, combinator_set=[S(), K(), I()]):
-        return CombinatorGene(random.choice(combinator_set))
+    def mutate(self, combinator_set, draw):
+        return CombinatorGene(pick(combinator_set, draw)[0])
 
     def __hash__(self):
         return hash("Nothing")
 
 
+# The evaluation stack of a prefix of genes is a linked list of (term, rest)
+# pairs, so the stacks of all the prefixes of a genome share their cells.
+EMPTY_STACK = ()
+# The stack of a prefix with an application of fewer than two terms.
+UNDERFLOW = 'underflow'
+# The token of an Apply gene. A combinator gene's token is the graph of its
+# combinator, which is interned, so equal terms have the same token.
+APPLY = 'apply'
+# Evaluation stacks by prefix, keyed by the length and the rolling hash of
+# the tokens of the prefix, see `Genome.evaluate`. Every entry keeps the
+# tokens it was built from, since different prefixes can share a key.
+PREFIX_STACKS = LRUCache(1 << 18)
+
+def prefix_keys(tokens):
+    # The keys of every prefix of the tokens.
+    keys = []
+    rolling = 0
+    for token in tokens:
+        rolling = hash((rolling, id(token)))
+        keys.append((len(keys) + 1, rolling))
+    return keys
+
+def same_prefix(tokens, other, length):
+    # Whether the first `length` tokens are the same terms. Leaves compare
+    # equal by their class and arguments alone, so they are compared by
+    # identity.
+    return len(tokens) >= length and all(a is b for a, b in zip(tokens[:length], other[:length]))
+
 class Genome:
     def __init__(self, genes, combinator_set=[S(), K(), I()]):
         self.genes = genes
         self.combinator_set = combinator_set
-
-    def random(length=10, combinator_set=[S(), K(), I()]):
-        result = Genome([CombinatorGene.random() for _ in range(length)], combinator_set)
-        for _ in range(10):
-            result.mutate()
+        # The fitness is computed once, and forgotten when the genes change.
+        self._fitness = None
+        # The steps taken and nodes visited by the last evaluation, and
+        # whether it ran out of budget.
+        self.steps = 0
+        self.term_size = 0
+        self.diverged = False
+
+    def random(length=10, combinator_set=[S(), K(), I()], rng=RNG):
+        result = Genome([CombinatorGene.random(rng=rng) for _ in range(length)], combinator_set)
+        mutate_population([result], 10, rng)
         return result
 
     def encode(self):
@@ -389,8 +799,10 @@ class Genome:
         # Assign a number to each combinator.
         combinator_to_number = {combinator: i for i, combinator in enumerate(self.combinator_set)}
 
-        # For each gene, encode it as a number.
-        return [combinator_to_number[gene.combinator] if isinstance(gene, CombinatorGene) else len(combinator_to_number) for gene in self.genes]
+        # For each gene, encode it as a number. Applications come after the
+        # combinators, and then nothing.
+        application = len(combinator_to_number)
+        return [combinator_to_number[gene.combinator] if isinstance(gene, CombinatorGene) else application if isinstance(gene, ApplicationGene) else application + 1 for gene in self.genes]
         
     def decode(genes, combinator_set=[S(), K(), I()]):
         # Decode the genome from a list of numbers.
@@ -398,9 +810,15 @@ class Genome:
         combinator_to_number = {combinator: i for i, combinator in enumerate(combinator_set)}
 
         # For each gene, encode it as a number.
-        return Genome([CombinatorGene(combinator_set[gene]) if gene < len(combinator_to_number) else ApplicationGene() for gene in genes], combinator_set)
+        application = len(combinator_to_number)
+        return Genome([CombinatorGene(combinator_set[gene]) if gene < application else ApplicationGene() if gene == application else NothingGene() for gene in genes], combinator_set)
 
     def fitness(self):
+        if self._fitness is None:
+            self._fitness = self.compute_fitness()
+        return self._fitness
+
+    def compute_fitness(self):
         # Evaluate the program.
         result = self.evaluate()
         # Is the result a Data object?
@@ -423,57 +841,103 @@ class Genome:
     def from_combinators(combinator_set=[S(), K(), I()], size=50):
         return Genome([CombinatorGene.random(combinator_set) for _ in range(size)], combinator_set)
 
-    def random_gene(self):
-        return random.choice([NothingGene(), ApplicationGene(), CombinatorGene.random(self.combinator_set)])
+    def random_gene(self, rng=RNG):
+        return rng.choice([NothingGene(), ApplicationGene(), CombinatorGene.random(self.combinator_set, rng)])
 
     def clone(self):
-        return Genome([gene.clone() for gene in self.genes])
+        return Genome([gene.clone() for gene in self.genes], self.combinator_set)
 
-    def insert_random_gene(self):
-        index = random.randint(0, len(self.genes) - 1)
-        self.genes.insert(index, self.random_gene())
+    def insert_random_gene(self, rng=RNG):
+        index = rng.randint(0, len(self.genes) - 1)
+        self.genes.insert(index, self.random_gene(rng))
+        self._fitness = None
 
-    def remove_random_gene(self):
+    def remove_random_gene(self, rng=RNG):
         if len(self.genes) < 2:
             return
-        index = random.randint(0, len(self.genes) - 1)
+        index = rng.randint(0, len(self.genes) - 1)
         self.genes.pop(index)
-
-    def mutate(self):
-        if random.random() < 0.5:
-            if random.random() < 0.5:
-                self.insert_random_gene()
-            else:
-                self.remove_random_gene()
-        else:
-            # Randomly mutate a gene.
-            index = random.randint(0, len(self.genes) - 1)
-            self.genes[index] = self.genes[index].mutate(self.combinator_set)
-
-
-    def crossover(self, other):
+        self._fitness = None
+
+    def mutate(self, rng=RNG):
+        self.apply_mutation(rng.random(), rng.random(), rng.random())
+
+    def apply_mutation(self, kind, position, draw):
+        # Inserts a random gene a quarter of the time, removes one a quarter
+        # of the time, and mutates one otherwise. The three uniform draws
+        # pick the kind, the gene, and what it becomes, so the mutations of
+        # a whole population can be drawn at once, see `mutate_population`.
+        self._fitness = None
+        index = int(position * len(self.genes))
+        if kind < 0.25:
+            gene, draw = pick((NothingGene, ApplicationGene, CombinatorGene), draw)
+            self.genes.insert(index, CombinatorGene(pick(self.combinator_set, draw)[0]) if gene is CombinatorGene else gene())
+        elif kind < 0.5:
+            if len(self.genes) >= 2:
+                self.genes.pop(index)
+        elif self.genes:
+            self.genes[index] = self.genes[index].mutate(self.combinator_set, draw)
+
+
+    def crossover(self, other, rng=RNG):
         # Randomly select a crossover point.
-        index = random.randint(0, len(self.genes) - 1)
+        index = rng.randint(0, len(self.genes) - 1)
         # Create two new genomes by swapping the genes after the crossover point.
         return Genome(self.genes[:index] + other.genes[index:], self.combinator_set), Genome(other.genes[:index] + self.genes[index:], self.combinator_set)
 
-    def evaluate(self):
-        # Evaluate the program.
-        stack = []
-        for gene in self.genes:
-            if isinstance(gene, CombinatorGene):
-                stack.append(gene.combinator)
-            elif isinstance(gene, ApplicationGene):
-                try:
-                    f = stack.pop()
-                    x = stack.pop()
-                    stack.append(f(*x))
-                except:
-                    return None
-        # The result should be at the top of the stack.
-        if len(stack) != 1:
+    def evaluate(self, step_limit=Reducer.STEP_LIMIT, size_limit=Reducer.SIZE_LIMIT):
+        # Evaluate the program. An Apply gene applies the function on top of
+        # the stack to the arguments of the term below it, like f(*x), so
+        # that term is reduced to its normal form first. The rest of the
+        # graph is only reduced once it is complete. The stack of terms
+        # after every prefix of the genes is cached, so a genome that shares
+        # a prefix with one evaluated before starts from there. Returns None
+        # if the term has no normal form within the budget, or the program
+        # is malformed.
+        reducer = Reducer(step_limit, size_limit)
+        self.steps, self.term_size, self.diverged = 0, 0, False
+        genes = [gene for gene in self.genes if not isinstance(gene, NothingGene)]
+        result = None
+        try:
+            tokens = tuple(reducer.to_graph(gene.combinator) if isinstance(gene, CombinatorGene) else APPLY for gene in genes)
+            keys = prefix_keys(tokens)
+            start = 0
+            stack = EMPTY_STACK
+            for length in range(len(tokens), 0, -1):
+                cached = PREFIX_STACKS.get(keys[length - 1])
+                if cached is not None and same_prefix(cached[0], tokens, length):
+                    start, stack = length, cached[1]
+                    break
+            for token, key in zip(tokens[start:], keys[start:]):
+                if stack is UNDERFLOW:
+                    break
+                if token is not APPLY:
+                    stack = (token, stack)
+                elif stack is EMPTY_STACK or stack[1] is EMPTY_STACK:
+                    stack = UNDERFLOW
+                else:
+                    f, (x, rest) = stack
+                    x = reducer.normalize(x)
+                    if type(x) is Diverged:
+                        # Divergence depends on the budget, so the prefix
+                        # is not cached.
+                        result = x
+                        break
+                    for arg in unwind(x)[1]:
+                        f = app(f, arg)
+                    stack = (f, rest)
+                PREFIX_STACKS.put(key, (tokens, stack))
+            # The result should be the only term on the stack.
+            if result is None and stack is not UNDERFLOW and stack is not EMPTY_STACK and stack[1] is EMPTY_STACK:
+                result = reducer.reduce(stack[0])
+        except Exception:
+            # Lambdas may be applied to terms they cannot handle.
+            result = None
+        self.steps, self.term_size = reducer.steps, reducer.size
+        if type(result) is Diverged:
+            self.diverged = True
             return None
-        return stack.pop()
+        return result
     
     def as_tree(self):
         # Generate a tree representation of the program.
@@ -505,6 +969,145 @@ def size(l):
     else:
         return 0
 
+def random_population(count, length, combinator_set, rng=RNG):
+    # The starting genes of the whole population are drawn at once, then
+    # every genome gets the same ten mutations as `Genome.random`.
+    indices = rng.integers(0, len(BASE_COMBINATORS) - 1, count * length)
+    genomes = []
+    for start in range(0, count * length, length):
+        genomes.append(Genome([CombinatorGene(BASE_COMBINATORS[i]) for i in indices[start:start + length]], combinator_set))
+    mutate_population(genomes, 10, rng)
+    return genomes
+
+def mutate_population(genomes, rounds=1, rng=RNG):
+    # Mutates every genome in place `rounds` times. The draws of all the
+    # mutations are made at once.
+    draws = rng.uniform(1.0, 3 * rounds * len(genomes))
+    for i, genome in enumerate(genomes * rounds):
+        genome.apply_mutation(*draws[3 * i:3 * i + 3])
+
+def breed(parents):
+    # Mutated copies of the parents, and of crossovers of pairs of them.
+    children = deepcopy(parents)
+    for i in range(0, len(parents) - 1, 2):
+        children.extend(parents[i].crossover(parents[i + 1]))
+    mutate_population(children)
+    return children
+
+# The combinator set of a worker process, see `evaluate_genomes`.
+WORKER = {}
+
+def init_worker(combinator_set):
+    WORKER['combinator_set'] = combinator_set
+
+def encoded_fitness(genes):
+    genome = Genome.decode(genes, WORKER['combinator_set'])
+    return genome.fitness(), genome.steps, genome.term_size, genome.diverged
+
+def evaluate_genomes(genomes, pool=None, workers=1):
+    # Computes the fitness of every genome that does not know its own yet,
+    # once for every distinct genome. With a pool of `workers` processes
+    # started by `start_pool`, the genomes are sent to its workers as integer
+    # vectors, because lambdas cannot be pickled. Returns the total reduction counts of the
+    # genomes it evaluated.
+    pending = {}
+    for genome in genomes:
+        if genome._fitness is None:
+            pending.setdefault(tuple(genome.encode()), []).append(genome)
+    if pool is None:
+        results = []
+        for same in pending.values():
+            genome = same[0]
+            results.append((genome.fitness(), genome.steps, genome.term_size, genome.diverged))
+    else:
+        results = pool.map(encoded_fitness, pending.keys(), chunksize=max(1, len(pending) // (8 * workers)))
+    counts = {'evaluated': len(results), 'steps': 0, 'size': 0, 'diverged': 0}
+    for same, (fitness, steps, term_size, diverged) in zip(pending.values(), results):
+        counts['steps'] += steps
+        counts['size'] += term_size
+        counts['diverged'] += diverged
+        for genome in same:
+            genome._fitness = fitness
+            genome.steps, genome.term_size, genome.diverged = steps, term_size, diverged
+    return counts
+
+def format_counts(counts):
+    return f"{counts['evaluated']} evaluated, {counts['steps']} steps, {counts['size']} nodes, {counts['diverged']} diverged"
+
+def evaluate_generation(genomes, pool=None, workers=1):
+    # The fitnesses of a generation, for `Evolution`.
+    counts = evaluate_genomes(genomes, pool, workers)
+    print(f'Reduction: {format_counts(counts)}')
+    return [genome.fitness() for genome in genomes]
+
+def load_seeds(path, combinator_set):
+    # The genomes of a database written by `ski_database.py`, which must be
+    # built over the same combinator set. The database module imports this
+    # one, so it is only imported here.
+    from ski_database import SKIDatabase
+    database = SKIDatabase.load(path, combinator_set)
+    return [Genome.decode(genes, combinator_set) for genes in database.genomes.values()]
+
+def start_pool(combinator_set, workers=None):
+    # Workers are forked, so they share the combinator set, lambdas and all.
+    return start_worker_pool(workers or WORKERS, init_worker, (combinator_set,))
+
+class CombinatorDecoder(Decoder):
+    # Decodes the integer vectors leap_ec evolves into genomes, see
+    # `Genome.encode`.
+    def __init__(self, combinator_set):
+        self.combinator_set = combinator_set
+
+    def decode(self, genome, *args, **kwargs):
+        return Genome.decode([int(gene) for gene in genome], self.combinator_set)
+
+class CombinatorProblem(ScalarProblem):
+    # The fitness of a decoded genome, to be maximized.
+    def __init__(self, maximize=True):
+        super().__init__(maximize)
+
+    def evaluate(self, phenome, *args, **kwargs):
+        return phenome.fitness()
+
+def leap_evolve(generations, pop_size, combinator_set, length=None, client=None):
+    # Runs the GA as a leap_ec generational EA over fixed length integer
+    # vectors, with every gene one of the combinators, an application or
+    # nothing. Individuals are evaluated by the workers of a dask client,
+    # on a local cluster of processes unless a client is given. Returns the
+    # last population. Only this needs dask, so it is imported here.
+    from leap_ec.distrib import DistributedIndividual, synchronous
+    from distributed import Client, LocalCluster
+    bounds = [(0, len(combinator_set) + 1)] * (length or GENOME_SIZE)
+    cluster = None
+    if client is None:
+        cluster = LocalCluster(n_workers=WORKERS, threads_per_worker=1, processes=True)
+        client = Client(cluster)
+    try:
+        representation = Representation(
+            initialize=create_int_vector(bounds),
+            decoder=CombinatorDecoder(combinator_set),
+            individual_cls=DistributedIndividual,
+        )
+        return generational_ea(
+            max_generations=generations,
+            pop_size=pop_size,
+            problem=CombinatorProblem(),
+            representation=representation,
+            pipeline=[
+                ops.tournament_selection,
+                ops.clone,
+                mutate_randint(bounds=bounds, expected_num_mutations=1),
+                ops.UniformCrossover(p_swap=0.2),
+                synchronous.eval_pool(client=client, size=pop_size),
+                BestSoFarProbe(),
+            ],
+            init_evaluate=synchronous.eval_population(client=client),
+        )
+    finally:
+        if cluster is not None:
+            client.close()
+            cluster.close()
+
 genome = Genome([
     # Postfix notation.  k(k)(s)(i) -> i s k k
     CombinatorGene(I()),
@@ -528,35 +1131,33 @@ genome = Genome([
 # print([Genome.random() for _ in range(10)])
 GENOME_SIZE = 10
 POPULATION_SIZE = 10000
+# The number of processes that evaluate genomes.
+WORKERS = os.cpu_count() or 1
+# Set this to a database from `ski_database.py` to seed the first
+# generation with its best genomes.
+SEED_DATABASE = None
+# Set this to run the GA as a leap_ec pipeline instead, see `leap_evolve`.
+USE_LEAP = False
 combinator_set = [S(), K(), I(), Data(Point(0, 0)), Lambda(lambda point: Data(point.value.shift_by(1, 0))), Lambda(lambda point: Data(point.value.shift_by(0, 1)))]
-genomes = [Genome.random(GENOME_SIZE, combinator_set) for _ in range(POPULATION_SIZE)]
-genomes.sort()
-genomes = genomes[::-1]
-print(list(map(lambda g: g.fitness(), genomes)))
-
-for epoch in range(1000):
-    print(f"Epoch {epoch}")
-
-    best_genomes = genomes[:POPULATION_SIZE//10]
-
-    print(list(map(lambda g: g.fitness(), best_genomes)))
-    # Create the next generation.
-    # The first 10 genomes are the best genomes from the previous generation.
-    genomes = deepcopy(best_genomes) + [Genome.random(GENOME_SIZE, combinator_set) for _ in range(POPULATION_SIZE - len(best_genomes))]
-
-    # Cross over the best genomes.
-    for i in range(0, len(best_genomes), 2):
-        child1, child2 = best_genomes[i].crossover(best_genomes[i + 1])
-        genomes.append(child1)
-        genomes.append(child2)
-    
-    # Mutate the genomes.
-    for genome in genomes:
-        genome.mutate()
-
-    genomes.extend(best_genomes)
-    # Sort the genomes by fitness.
-    genomes.sort()
-    genomes = genomes[::-1]
 
-print(list(map(lambda g: g.fitness(), genomes)))
\ No newline at end of file
+if __name__ == '__main__' and USE_LEAP:
+    population = leap_evolve(1000, POPULATION_SIZE, combinator_set)
+    print(sorted((individual.fitness for individual in population), reverse=True))
+elif __name__ == '__main__':
+    RNG.seed(SEED)
+    pool = start_pool(combinator_set) if WORKERS > 1 else None
+    genomes = random_population(POPULATION_SIZE, GENOME_SIZE, combinator_set)
+    if SEED_DATABASE is not None:
+        seeds = load_seeds(SEED_DATABASE, combinator_set)
+        evaluate_genomes(seeds, pool, WORKERS)
+        seeds = sorted(seeds, key=Genome.fitness, reverse=True)[:POPULATION_SIZE // 10]
+        genomes = seeds + genomes[len(seeds):]
+
+    evolution = Evolution(
+        POPULATION_SIZE,
+        lambda count: random_population(count, GENOME_SIZE, combinator_set),
+        breed,
+        evaluate=lambda genomes: evaluate_generation(genomes, pool, WORKERS),
+    )
+    genomes, scores = evolution.run(1000, genomes)
+    print(scores)
@@ -0,0 +1,124 @@
+from multiprocessing import get_context
+from time import time
+
+# A generational genetic algorithm, shared by `turing.py`,
+# `evolve_sage_create.py` and `combinator.py`. A script plugs its genomes
+# in with a few functions:
+#
+#   random_genomes(count)  `count` new random genomes.
+#   breed(parents)         the children of the best genomes of a generation,
+#                          by crossover and mutation. The parents must not
+#                          be changed, they are kept as they are.
+#   fitness(genome)        the fitness of a genome. Higher is better.
+#
+# Every generation has exactly `population_size` genomes: the best
+# `elite_fraction` of the last generation, their children, and new random
+# genomes to fill the rest. Every genome is evaluated once, when it is
+# created, and the scores of the parents are kept with them.
+
+def breed(parents, mutate_population):
+    # Crossovers of pairs of the parents, and waves of mutated copies of
+    # them: every child gets the same chance to be mutated again as the
+    # genomes it came from. For genomes with `crossover` and
+    # `crossover_splits`, and a `mutate_population(genomes)` that returns
+    # mutated copies of some of them.
+    children = []
+    for i in range(0, len(parents) - 1, 2):
+        children.extend(parents[i].crossover(parents[i + 1]))
+        children.append(parents[i].crossover_splits(parents[i + 1]))
+    wave = mutate_population(parents + children)
+    while wave:
+        children.extend(wave)
+        wave = mutate_population(wave)
+    return children
+
+def report_best(epoch, genomes, scores):
+    # Prints the operations of the best genome, and what it evaluates to.
+    print(genomes[0].into_operations())
+    print(genomes[0].evaluate())
+
+# The fitness function and decoder of a worker process, see `start_pool`.
+WORKER = {}
+
+def init_worker(fitness, decode):
+    WORKER['fitness'] = fitness
+    WORKER['decode'] = decode
+
+def worker_fitness(encoded):
+    return WORKER['fitness'](WORKER['decode'](encoded))
+
+def start_pool(workers, initializer=None, initargs=()):
+    # Workers are forked, so they share the operation sets of the genomes,
+    # which hold lambdas and cannot be pickled. Genomes are sent to them in
+    # an encoded form instead, see `Evolution`.
+    return get_context('fork').Pool(workers, initializer=initializer, initargs=initargs)
+
+class Evolution:
+    # With `workers` > 1, the genomes are evaluated over a pool of forked
+    # processes. They are sent to the workers as `encode(genome)`, which
+    # must be picklable, and rebuilt there with `decode`. A script with its
+    # own way to evaluate a batch of genomes passes `evaluate(genomes)`,
+    # returning their fitnesses, instead.
+    def __init__(self, population_size, random_genomes, breed, fitness=None, evaluate=None,
+                 elite_fraction=0.1, workers=1, encode=None, decode=None, report=None):
+        if fitness is None and evaluate is None:
+            raise ValueError("Evolution needs a fitness or an evaluate function")
+        self.population_size = population_size
+        self.random_genomes = random_genomes
+        self.breed = breed
+        self.fitness = fitness
+        self.elite_size = max(2, int(population_size * elite_fraction))
+        # Called with the epoch, and the genomes and scores of the
+        # generation, best first, after every epoch.
+        self.report = report
+        self.encode = encode
+        self.workers = workers
+        self.pool = None
+        if evaluate is not None:
+            self.evaluate = evaluate
+        elif workers > 1:
+            if encode is None or decode is None:
+                raise ValueError("A worker pool needs encode and decode functions")
+            self.pool = start_pool(workers, init_worker, (fitness, decode))
+
+    def evaluate(self, genomes):
+        if self.pool is None:
+            return [self.fitness(genome) for genome in genomes]
+        chunksize = max(1, len(genomes) // (8 * self.workers))
+        return self.pool.map(worker_fitness, [self.encode(genome) for genome in genomes], chunksize=chunksize)
+
+    def rank(self, genomes, scores):
+        # The genomes and their scores, best first.
+        order = sorted(range(len(genomes)), key=scores.__getitem__, reverse=True)
+        return [genomes[i] for i in order], [scores[i] for i in order]
+
+    def run(self, epochs, genomes=None):
+        # Evolves the population for `epochs` generations, and returns the
+        # last one, best first, with its scores. The first generation is
+        # `genomes`, or random. Interrupting the run returns the last whole
+        # generation.
+        if genomes is None:
+            genomes = self.random_genomes(self.population_size)
+        genomes = genomes[:self.population_size]
+        genomes, scores = self.rank(genomes, self.evaluate(genomes))
+        try:
+            for epoch in range(epochs):
+                print(f"Epoch {epoch}")
+                epoch_start = time()
+                parents = genomes[:self.elite_size]
+                print(scores[:self.elite_size])
+                room = self.population_size - len(parents)
+                children = self.breed(parents)[:room]
+                children += self.random_genomes(room - len(children)) if room > len(children) else []
+                genomes, scores = self.rank(parents + children, scores[:len(parents)] + list(self.evaluate(children)))
+                if self.report is not None:
+                    self.report(epoch, genomes, scores)
+                print(f'Epoch time: {time() - epoch_start:.2f}s')
+        except KeyboardInterrupt:
+            pass
+        return genomes, scores
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
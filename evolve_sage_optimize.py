@@ -4,10 +4,24 @@ import numpy as np
 from time import time
 import sys
 import math
+import os
+import pickle
+import resource
+import signal
+from multiprocessing import Process, Pipe, shared_memory, resource_tracker
+from multiprocessing.connection import wait
+from functools import partial
+from itertools import product, count
+from collections import OrderedDict, Counter, deque
+from bisect import bisect_left, bisect_right
+from symbol_histogram import SymbolHistogram
+
+# The longest a tape can grow before a program is stopped.
+MAX_TAPE_LENGTH = 1 << 22
 
 
 class Tape:
-    def __init__(self, length=10000, blank_symbol=0, head_position=0):
+    def __init__(self, length=10000, blank_symbol=0, head_position=0, histogram=False):
         self.tape = [blank_symbol] * length
         self.head_position = head_position
         self.register = self.blank_symbol = blank_symbol
@@ -16,6 +30,10 @@ class Tape:
         self.deref_stack = []
         self.tm = None
         self.env = {}
+        # With a histogram, the values on the tape are counted as they are
+        # written, and `entropy` does not have to read the tape. Code that
+        # replaces `tape` directly must not use one.
+        self.histogram = SymbolHistogram(self.tape) if histogram else None
     
     def __getitem__(self, index):
         # Check if index is out of bounds
@@ -23,7 +41,7 @@ class Tape:
             # If so, fill with blank symbols
             if index >= self.max_steps:
                 raise RuntimeError("Maximum number of steps exceeded")
-            self.tape += [self.blank_symbol] * (index - len(self.tape) + 1)
+            self.grow(index - len(self.tape) + 1)
         elif index < 0:
             return self.blank_symbol
         return self.tape[index]
@@ -32,11 +50,26 @@ class Tape:
         # Check if index is out of bounds
         if index >= len(self.tape):
             # If so, fill with blank symbols
-            self.tape += [self.blank_symbol] * (index - len(self.tape) + 1)
+            if index >= MAX_TAPE_LENGTH:
+                raise RuntimeError("Maximum tape length exceeded")
+            self.grow(index - len(self.tape) + 1)
         elif index < 0:
             return
+        if self.histogram is not None:
+            self.histogram.write(self.tape[index], value)
         self.tape[index] = value
 
+    def grow(self, count, value=None):
+        value = self.blank_symbol if value is None else value
+        self.tape += [value] * count
+        if self.histogram is not None:
+            self.histogram.extend(value, count)
+
+    def entropy(self):
+        # The entropy of the cells of the tape as weights, see `SymbolHistogram`.
+        histogram = self.histogram if self.histogram is not None else SymbolHistogram(self.tape)
+        return histogram.entropy()
+
     def add_env(self, key, value):
         self.env[key] = value
     
@@ -87,6 +120,8 @@ class SageVirtualMachine:
         self.input = input
         self.output = []
         self.step_position = 0
+        # The number of operations executed by the last run.
+        self.steps = 0
 
     def get_int(self):
         if len(self.input) == 0:
@@ -106,11 +141,13 @@ class SageVirtualMachine:
             for operation in self.operations:
                 operation.checked_apply(tape)
         except RuntimeError as e:
+            self.steps = tape.steps
             if str(e) == "Maximum number of steps exceeded":
                 tape.tm = None
                 return tape
             else:
                 raise e
+        self.steps = tape.steps
         tape.tm = None
         self.operations = []
         self.input = None
@@ -309,7 +346,7 @@ class PutChar(Operation):
     def apply(self, tape):
         try:
             tape.tm.output.append(chr(tape.register))
-        except:
+        except (ValueError, OverflowError, TypeError):
             pass
 
 class PutInt(Operation):
@@ -344,7 +381,11 @@ class Save(Operation):
 class Allocate(Operation):
     def apply(self, tape):
         tape.register = len(tape.tape)
-        tape.tape.extend([0] * (int(tape.register) + 32))
+        # Every allocation doubles the tape, so a loop of them runs out of
+        # memory long before it runs out of steps.
+        if 2 * len(tape.tape) + 32 > MAX_TAPE_LENGTH:
+            raise RuntimeError("Maximum tape length exceeded")
+        tape.grow(int(tape.register) + 32, 0)
 
 class IsNonNegative(Operation):
     def apply(self, tape):
@@ -514,6 +555,210 @@ def parse(code, token_start=0, fun_id=0, depth=0):
     return operations, i
 
 
+# The operations of an edit script. An edit script is a list of
+# (path, operation, value) edits, where the path is the list of indices
+# from the top of the genome down to the edited gene.
+INSERT = 'insert'
+REMOVE = 'remove'
+REPLACE = 'replace'
+
+def apply_edit(genes, path, operation, value=None):
+    # Returns a copy of the genes with the edit applied. Only the lists
+    # along the path are copied.
+    result = list(genes)
+    if len(path) > 1:
+        result[path[0]] = apply_edit(genes[path[0]], path[1:], operation, value)
+    elif operation == INSERT:
+        result.insert(path[0], value)
+    elif operation == REMOVE:
+        del result[path[0]]
+    else:
+        result[path[0]] = value
+    return result
+
+def apply_edits(genes, edits):
+    for path, operation, value in edits:
+        genes = apply_edit(genes, path, operation, value)
+    return genes
+
+def get_block(genes, path):
+    for index in path:
+        genes = genes[index]
+    return genes
+
+GENOME_IDS = count()
+
+class GeneStore:
+    # A hash-consing table for gene lists. Equal lists are interned to the
+    # same list object, so a population of nearly identical genomes stores
+    # every shared block once. A list is interned after its sub-lists, so it
+    # is keyed by its plain genes and the identities of its sub-lists, and
+    # interning it never walks the whole tree.
+    #
+    # Interned lists must never be changed in place, see `Genome.copy`.
+    def __init__(self):
+        self.blocks = {}
+        self.keys = {}
+
+    def intern(self, genes):
+        if id(genes) in self.keys:
+            return genes
+        interned = [self.intern(gene) if type(gene) == list else gene for gene in genes]
+        # Keep the list itself if its sub-lists were already interned, so
+        # whatever is cached for it stays valid.
+        if any(a is not b for a, b in zip(interned, genes)):
+            genes = interned
+        key = self.key(genes)
+        if key not in self.blocks:
+            self.blocks[key] = genes
+            self.keys[id(genes)] = key
+        return self.blocks[key]
+
+    def key(self, genes):
+        # Sub-lists are wrapped in a tuple so they never compare equal to a gene.
+        return tuple((id(gene),) if type(gene) == list else gene for gene in genes)
+
+    def retain(self, genomes):
+        # Forget every interned list that is not part of one of the genomes.
+        blocks, keys = {}, {}
+        def visit(genes):
+            if id(genes) in keys:
+                return
+            for gene in genes:
+                if type(gene) == list:
+                    visit(gene)
+            key = self.key(genes)
+            blocks[key] = genes
+            keys[id(genes)] = key
+        for genome in genomes:
+            visit(genome.genome)
+        self.blocks, self.keys = blocks, keys
+
+    def __len__(self):
+        return len(self.blocks)
+
+GENE_STORE = GeneStore()
+
+class IdentityCache:
+    # A least recently used cache keyed by the identities of a tuple of
+    # objects. Every entry keeps its objects alive, so their ids cannot be
+    # reused by other objects while the entry is cached.
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, objects):
+        key = tuple(map(id, objects))
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][1]
+
+    def put(self, objects, value):
+        self.entries[tuple(map(id, objects))] = (objects, value)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+# Decoded blocks of genes, keyed by the gene list and the operation set.
+DECODE_CACHE = IdentityCache(200000)
+# Running counts of plain genes in gene lists, see `gene_counts`.
+COUNT_CACHE = IdentityCache(200000)
+
+def gene_size(gene):
+    if type(gene) != list:
+        return 1
+    counts = gene_counts(gene)
+    return counts[-1] if counts else 0
+
+def gene_counts(genes):
+    # Returns the running total of plain genes in the list, counting the
+    # genes inside sub-lists, so `counts[i]` is the number of plain genes
+    # in `genes[:i + 1]`. Gene lists are never changed in place, so the
+    # counts of every list are only computed once while they are cached.
+    counts = COUNT_CACHE.get((genes,))
+    if counts is not None:
+        return counts
+    counts = []
+    total = 0
+    for gene in genes:
+        if type(gene) == list:
+            sub_counts = gene_counts(gene)
+            if sub_counts:
+                total += sub_counts[-1]
+        else:
+            total += 1
+        counts.append(total)
+    return COUNT_CACHE.put((genes,), counts)
+
+# The shapes a block of genes can have, by the type of its first gene:
+#
+#     [WhileLoop or If, body...]
+#     [IfElse, [then...], [else...]]
+#     [Function, name, body...]
+#     [MoveLeft, MoveRight or SetRegister, value]
+#
+# Any other block is a plain sequence of genes, see `Genome.decode_block`.
+BODY_BLOCK = 'body'
+IF_ELSE_BLOCK = 'if-else'
+FUNCTION_BLOCK = 'function'
+IMMEDIATE_BLOCK = 'immediate'
+PLAIN_BLOCK = 'plain'
+BLOCK_KINDS = {
+    WhileLoop: BODY_BLOCK,
+    If: BODY_BLOCK,
+    IfElse: IF_ELSE_BLOCK,
+    Function: FUNCTION_BLOCK,
+    MoveLeft: IMMEDIATE_BLOCK,
+    MoveRight: IMMEDIATE_BLOCK,
+    SetRegister: IMMEDIATE_BLOCK,
+}
+# The first index of a block where genes can be inserted or removed. The
+# genes before it give the block its shape. If-else and immediate blocks
+# have a fixed size, genes only go into the branches of an if-else block.
+FIRST_FREE_GENE = {
+    BODY_BLOCK: 1,
+    IF_ELSE_BLOCK: None,
+    FUNCTION_BLOCK: 2,
+    IMMEDIATE_BLOCK: None,
+    PLAIN_BLOCK: 1,
+}
+
+# The roles a plain gene can have, see `Genome.gene_role`.
+OPERATION_GENE = 'operation'
+HEAD_GENE = 'head'
+IMMEDIATE_GENE = 'immediate'
+NAME_GENE = 'name'
+
+# Random immediate values are drawn from this range.
+IMMEDIATE_RANGE = (-1, 16)
+
+KIND_CACHE = IdentityCache(16)
+
+def operation_kinds(operations):
+    # Returns the block kind of every operation index, and the operation
+    # indices of every block kind.
+    kinds = KIND_CACHE.get((operations,))
+    if kinds is not None:
+        return kinds
+    kind_of = [BLOCK_KINDS.get(type(operation), PLAIN_BLOCK) for operation in operations]
+    indices = {}
+    for i, kind in enumerate(kind_of):
+        indices.setdefault(kind, []).append(i)
+    return KIND_CACHE.put((operations,), (kind_of, indices))
+
+# The mutation operators, see `Genome.mutate`. Each structural operator
+# is the `<operator>_random_gene` method of a genome.
+POINT_MUTATION = 'point'
+STRUCTURAL_MUTATIONS = ['insert', 'remove', 'swap', 'modify']
+MUTATION_OPERATORS = [POINT_MUTATION] + STRUCTURAL_MUTATIONS
+# The default mix of structural mutations, which picks one of them for
+# every change it makes.
+STRUCTURAL_MIX = 'structural'
+
 # Genome looks like a list of numbers like so:
 # [1, 2, 3, [4, 5, [6, 7], [8, 9], 10], 11, 12, [[13, 14, 15], 16, [17]]]
 # This is a list of operations, where the numbers are the indices of the operations.
@@ -523,6 +768,15 @@ class Genome:
         self.operations = operations
         self.fitness_function = fitness_function
         self._fitness = None
+        # A child made by `copy` remembers its parent, and the edits that
+        # turn the parent's genes into its own.
+        self.id = next(GENOME_IDS)
+        self.parent_id = None
+        self.edits = None
+        # The mutation operator the genome was made with, see `mutate`.
+        self.operator = None
+        # Weights the mutation sites while the genome is mutated.
+        self.profile = None
 
         if genome is None:
             self.genome = []
@@ -530,13 +784,33 @@ class Genome:
             self.genome = genome
 
     def get_size(self):
-        total = 0
-        for gene in self.genome:
-            if type(gene) == list:
-                total += Genome(self.operations, gene).get_size()
-            else:
-                total += 1
-        return total
+        counts = gene_counts(self.genome)
+        return counts[-1] if counts else 0
+
+    def site(self, index, path=()):
+        # Returns the path to the plain gene with the given index in the block
+        # at `path`, counting plain genes depth first. Every step down the
+        # tree is a binary search over the running counts of a list.
+        genes = get_block(self.genome, path)
+        while True:
+            counts = gene_counts(genes)
+            i = bisect_right(counts, index)
+            if i > 0:
+                index -= counts[i - 1]
+            path += (i,)
+            if type(genes[i]) != list:
+                return path
+            genes = genes[i]
+
+    def random_site(self, path=()):
+        # A path to a plain gene, chosen uniformly over the block at `path`,
+        # or weighted by the site profile while the whole genome is mutated.
+        if self.profile is not None and path == ():
+            return self.profile.site(self)
+        counts = gene_counts(get_block(self.genome, path))
+        if not counts or counts[-1] == 0:
+            return None
+        return self.site(random.randrange(counts[-1]), path)
 
     def set_fitness_function(self, fitness_function):
         self.fitness_function = fitness_function
@@ -576,35 +850,85 @@ class Genome:
     def get_operation(self, index):
         return self.operations[index]
     
-    def mutate(self, mutation_rate):
+    def mutate(self, mutation_rate, path=(), operator=None, profile=None):
+        # Mutates the block at `path` with one of the `MUTATION_OPERATORS`,
+        # and remembers which one. Without an operator, point mutation is
+        # picked half of the time, and the `STRUCTURAL_MIX` otherwise.
+        # With a `SiteProfile` of the parent, the structural operators pick
+        # their sites by its weights. Every change is made through `edit`, so
+        # it is recorded in the edit script of a child genome.
         self._fitness = None
-        if random.random() < 0.5:
-            for i in range(len(self.genome)):
+        if operator is None:
+            operator = POINT_MUTATION if random.random() < 0.5 else STRUCTURAL_MIX
+        if path == ():
+            self.operator = operator
+            self.profile = profile
+        genes = get_block(self.genome, path)
+        if operator == POINT_MUTATION:
+            for i in range(len(genes)):
                 if random.random() < mutation_rate:
-                    if type(self.genome[i]) == list:
-                        self.genome[i] = list(Genome(self.operations, deepcopy(self.genome[i])).mutate(mutation_rate).genome)
+                    if type(genes[i]) == list:
+                        self.mutate(mutation_rate, path + (i,), operator)
                     else:
-                        self.genome[i] = random.randint(0, len(self.operations) - 1)
+                        value = self.random_value(path + (i,))
+                        if value is not None:
+                            self.edit(path + (i,), REPLACE, value)
         else:
+            # The structural mutations pick their genes uniformly from the
+            # whole block, including the genes of nested blocks.
             for i in range(random.randint(1, 5)):
-                if random.random() < 0.5:
-                    if random.random() < 0.5:
-                        self.insert_random_gene()
-                    else:
-                        self.remove_random_gene()
-                else:
-                    if random.random() < 0.5:
-                        self.swap_random_gene()
-                    else:
-                        self.modify_random_gene()
+                mutation = random.choice(STRUCTURAL_MUTATIONS) if operator == STRUCTURAL_MIX else operator
+                getattr(self, f'{mutation}_random_gene')(path)
 
+        if path == ():
+            self.profile = None
+            self.intern()
         return self
-            
+
+    def edit(self, path, operation, value=None):
+        # Interned gene lists are shared with other genomes, so the edit
+        # copies the lists along the path instead of changing them in place.
+        old_genome = self.genome
+        self.genome = apply_edit(self.genome, path, operation, value)
+        if self.edits is not None:
+            self.edits.append((path, operation, value))
+        self.update_counts(old_genome, path, operation, value)
+        if self.profile is not None:
+            self.profile.edited(self, old_genome, path, operation, value)
+
+    def update_counts(self, old_genome, path, operation, value):
+        # Derives the running gene counts of the lists copied by an edit from
+        # the counts of the lists they replace, so that picking the next
+        # mutation site does not have to count them again.
+        old_blocks = [old_genome]
+        new_blocks = [self.genome]
+        for index in path[:-1]:
+            old_blocks.append(old_blocks[-1][index])
+            new_blocks.append(new_blocks[-1][index])
+
+        old_gene = old_blocks[-1][path[-1]] if operation != INSERT else None
+        delta = 0
+        if operation != REMOVE:
+            delta += gene_size(value)
+        if operation != INSERT:
+            delta -= gene_size(old_gene)
+
+        for depth, (old_block, new_block) in enumerate(zip(old_blocks, new_blocks)):
+            counts = gene_counts(old_block)
+            i = path[depth]
+            if depth < len(path) - 1 or operation == REPLACE:
+                new_counts = counts[:i] + [count + delta for count in counts[i:]]
+            elif operation == INSERT:
+                new_counts = counts[:i] + [(counts[i - 1] if i > 0 else 0) + delta] + [count + delta for count in counts[i:]]
+            else:
+                new_counts = counts[:i] + [count + delta for count in counts[i + 1:]]
+            COUNT_CACHE.put((new_block,), new_counts)
+
     def crossover(self, other):
         # Randomly select a crossover point.
         index = random.randint(0, min(len(self.genome) - 1, len(other.genome) - 1))
         # Create two new genomes by swapping the genes after the crossover point.
-        return Genome(self.operations, self.genome[:index] + other.genome[index:], fitness_function=self.fitness_function), Genome(self.operations, other.genome[:index] + self.genome[index:], fitness_function=self.fitness_function)
+        return Genome(self.operations, self.genome[:index] + other.genome[index:], fitness_function=self.fitness_function).intern(), Genome(self.operations, other.genome[:index] + self.genome[index:], fitness_function=self.fitness_function).intern()
 
     def crossover_splits(self, other):
         result = []
@@ -616,122 +940,240 @@ class Genome:
                     result.append(a)
                 else:
                     result.append(b)
-        return Genome(self.operations, result, fitness_function=self.fitness_function)
-
-    def remove_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    if random.random() < 0.5:
-                        self.genome[i] = list(Genome(self.operations, self.genome[i]).remove_random_gene().genome)
-                    else:
-                        del self.genome[i]
-                else:
-                    del self.genome[i]
+        return Genome(self.operations, result, fitness_function=self.fitness_function).intern()
+
+    def block_kind(self, genes):
+        # The kind of a block, or None for a block that starts with a
+        # sub-list, which is a sequence followed by more genes.
+        if len(genes) == 0 or type(genes[0]) == list:
+            return None
+        kind_of = operation_kinds(self.operations)[0]
+        if not 0 <= genes[0] < len(kind_of):
+            return PLAIN_BLOCK
+        return kind_of[genes[0]]
+
+    def block_context(self, path):
+        # Returns whether the list at `path` is a sequence of genes, and its
+        # block kind if it is not. Top level genes and if-else branches are
+        # sequences, and every list in a sequence is a block.
+        genes = self.genome
+        sequence = True
+        for i in path:
+            if sequence:
+                sequence = False
+            else:
+                kind = self.block_kind(genes)
+                sequence = (kind is None and i == 0) or kind == IF_ELSE_BLOCK
+            genes = genes[i]
+        if sequence:
+            return True, None
+        return False, self.block_kind(genes)
+
+    def gene_role(self, path):
+        # Returns the role of the plain gene at `path`, and the kind of the
+        # block it is in.
+        sequence, kind = self.block_context(path[:-1])
+        if sequence or self.is_free(path, kind):
+            return OPERATION_GENE, kind
+        if path[-1] == 0:
+            return HEAD_GENE, kind
+        if kind == IMMEDIATE_BLOCK and path[-1] == 1:
+            return IMMEDIATE_GENE, kind
+        return NAME_GENE, kind
+
+    def is_free(self, path, kind=False):
+        # Whether a gene can be inserted or removed at `path` without
+        # changing the shape of the block it is in.
+        if kind is False:
+            sequence, kind = self.block_context(path[:-1])
+            if sequence:
+                return True
+        first = 1 if kind is None else FIRST_FREE_GENE[kind]
+        return first is not None and path[-1] >= first
+
+    def random_value(self, path):
+        # A random replacement for the plain gene at `path` that keeps the
+        # genome decodable: heads stay heads of the same block kind, and
+        # immediates and names stay numbers.
+        role, kind = self.gene_role(path)
+        if role == OPERATION_GENE:
+            return random.randint(0, len(self.operations) - 1)
+        if role == HEAD_GENE:
+            return random.choice(operation_kinds(self.operations)[1][kind])
+        if role == IMMEDIATE_GENE:
+            return random.randint(*IMMEDIATE_RANGE)
+        return None
+
+    def random_gene(self):
+        # A random well formed gene to insert: a plain operation, or a new
+        # block with an immediate or a one gene body.
+        gene = random.randint(0, len(self.operations) - 1)
+        kind = operation_kinds(self.operations)[0][gene]
+        if random.random() < 0.5 or kind in (PLAIN_BLOCK, FUNCTION_BLOCK):
+            return gene
+        if kind == IMMEDIATE_BLOCK:
+            return [gene, random.randint(*IMMEDIATE_RANGE)]
+        body = [random.randint(0, len(self.operations) - 1)]
+        if kind == IF_ELSE_BLOCK:
+            return [gene, body, []]
+        return [gene] + body
+
+    def remove_random_gene(self, path=()):
+        site = self.random_site(path)
+        if site is None:
+            return self
+        # Genes that give a block its shape are only removed with the whole
+        # block.
+        while not self.is_free(site):
+            site = site[:-1]
+            if len(site) <= len(path):
                 return self
+        self.edit(site, REMOVE)
         return self
     
-    def insert_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).insert_random_gene().genome)
-                else:
-                    self.genome.insert(i, random.randint(0, len(self.operations) - 1))
+    def insert_random_gene(self, path=()):
+        site = self.random_site(path)
+        if site is None:
+            site = path + (len(get_block(self.genome, path)),)
+        else:
+            site = site[:-1] + (site[-1] + random.randint(0, 1),)
+        while not self.is_free(site):
+            site = site[:-1]
+            if len(site) <= len(path):
                 return self
-        self.genome.append(random.randint(0, len(self.operations) - 1))
+        self.edit(site, INSERT, self.random_gene())
         return self
     
-    def swap_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).swap_random_gene().genome)
-                else:
-                    self.genome[i] = random.randint(0, len(self.operations) - 1)
-                return self
+    def swap_random_gene(self, path=()):
+        site = self.random_site(path)
+        if site is not None:
+            value = self.random_value(site)
+            if value is not None:
+                self.edit(site, REPLACE, value)
         return self
     
-    def modify_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).modify_random_gene().genome)
-                else:
-                    self.genome[i] = min(self.genome[i] + random.randint(-1, 1), len(self.operations) - 1)
-                return self
+    def modify_random_gene(self, path=()):
+        site = self.random_site(path)
+        if site is None:
+            return self
+        gene = get_block(self.genome, site)
+        role, kind = self.gene_role(site)
+        if role == OPERATION_GENE:
+            value = max(0, min(gene + random.randint(-1, 1), len(self.operations) - 1))
+        elif role == HEAD_GENE:
+            # Step to a neighbouring operation of the same block kind.
+            indices = operation_kinds(self.operations)[1][kind]
+            i = bisect_right(indices, gene) - 1 + random.randint(-1, 1)
+            value = indices[max(0, min(i, len(indices) - 1))]
+        elif role == IMMEDIATE_GENE:
+            value = gene + random.randint(-1, 1)
+        else:
+            return self
+        self.edit(site, REPLACE, value)
         return self
 
     def into_operations(self):
-        func_count = 0
         operations = []
         for operation in self.genome:
             if type(operation) == list:
-                # Get whether this is supposed to be a loop, deref, or function
-                if len(operation) == 0:
-                    continue
-                if type(operation[0]) == list:
-                    operations.extend(Genome(self.operations, operation[0]).into_operations())
-                    operations.extend(Genome(self.operations, operation[1:]).into_operations())
-                    continue
-                operation_type = type(self.get_operation(operation[0]))
-
-                if operation_type == WhileLoop:
-                    operations.append(WhileLoop(Genome(self.operations, operation[1:]).into_operations()))
-                elif operation_type == If:
-                    operations.append(If(Genome(self.operations, operation[1:]).into_operations()))
-                elif operation_type == MoveRight:
-                    operations.append(MoveRight(operation[1]))
-                elif operation_type == MoveLeft:
-                    operations.append(MoveLeft(operation[1]))
-                elif operation_type == SetRegister:
-                    if len(operation) == 2:
-                        operations.append(SetRegister(operation[1]))
-                    else:
-                        raise Exception('SetRegister with no value')
-                elif operation_type == IfElse:
-                    if len(operation) == 3:
-                        operations.append(IfElse(Genome(self.operations, operation[1]).into_operations(), Genome(self.operations, operation[2]).into_operations()))
-                    # elif len(operation) == 2:
-                    #     operations.append(If(Genome(self.operations, operation[1]).into_operations()))
-                    else:
-                        raise Exception('IfElse with no value')
-                        # operations.append(If(Genome(self.operations, operation[1:]).into_operations()))
-                elif operation_type == Function:
-                    operations.append(Function(int(operation[1]), Genome(self.operations, operation[2:]).into_operations()))
-                    # func_count += 1
-                else:
-                    # print("Unknown operation type", operation_type)
-                    operations.extend(Genome(self.operations, operation[:]).into_operations())
+                operations.extend(self.decode_block(operation))
             else:
                 if operation >= len(self.operations):
                     raise IndexError(f"Operation index {operation} is out of range")
                 operations.append(self.get_operation(operation))
                 
         return operations
+
+    def decode_block(self, operation):
+        # Blocks are decoded once and then reused for as long as they are
+        # cached. A child shares every block with its parent except the ones
+        # on the path to the mutated gene, so only that path is rebuilt.
+        operations = DECODE_CACHE.get((operation, self.operations))
+        if operations is not None:
+            return operations
+
+        operations = []
+        # Get whether this is supposed to be a loop, deref, or function
+        if len(operation) == 0:
+            pass
+        elif type(operation[0]) == list:
+            operations.extend(Genome(self.operations, operation[0]).into_operations())
+            operations.extend(Genome(self.operations, operation[1:]).into_operations())
+        else:
+            operation_type = type(self.get_operation(operation[0]))
+
+            if operation_type == WhileLoop:
+                operations.append(WhileLoop(Genome(self.operations, operation[1:]).into_operations()))
+            elif operation_type == If:
+                operations.append(If(Genome(self.operations, operation[1:]).into_operations()))
+            elif operation_type == MoveRight:
+                operations.append(MoveRight(operation[1]))
+            elif operation_type == MoveLeft:
+                operations.append(MoveLeft(operation[1]))
+            elif operation_type == SetRegister:
+                if len(operation) == 2:
+                    operations.append(SetRegister(operation[1]))
+                else:
+                    raise Exception('SetRegister with no value')
+            elif operation_type == IfElse:
+                if len(operation) == 3:
+                    operations.append(IfElse(Genome(self.operations, operation[1]).into_operations(), Genome(self.operations, operation[2]).into_operations()))
+                # elif len(operation) == 2:
+                #     operations.append(If(Genome(self.operations, operation[1]).into_operations()))
+                else:
+                    raise Exception('IfElse with no value')
+                    # operations.append(If(Genome(self.operations, operation[1:]).into_operations()))
+            elif operation_type == Function:
+                operations.append(Function(int(operation[1]), Genome(self.operations, operation[2:]).into_operations()))
+            else:
+                # print("Unknown operation type", operation_type)
+                operations.extend(Genome(self.operations, operation[:]).into_operations())
+
+        return DECODE_CACHE.put((operation, self.operations), operations)
     
     def copy(self):
-        return Genome(deepcopy(self.operations), deepcopy(self.genome), fitness_function=deepcopy(self.fitness_function))
+        # Gene lists are never changed in place: the mutation operators copy
+        # every list on the way down to the gene they edit. So a copy shares
+        # every list with the original.
+        child = Genome(self.operations, self.genome, fitness_function=self.fitness_function)
+        child.parent_id = self.id
+        child.edits = []
+        return child
 
     def fitness(self):
         if self._fitness is not None:
             return self._fitness
 
         if self.fitness_function is not None:
-            self._fitness = self.fitness_function(deepcopy(self))
+            self._fitness = self.fitness_function(self.copy())
             return self._fitness
         else:
             raise Exception("No fitness function defined")
 
     def evaluate(self, input=None, max_steps=100000):
         tape = Tape()
-        tm = SageVirtualMachine(deepcopy(self.into_operations()), input)
+        tm = SageVirtualMachine(self.into_operations(), input)
         tm.run(tape, steps=max_steps)
         return tm
 
+    def intern(self):
+        self.genome = GENE_STORE.intern(self.genome)
+        return self
+
     def __lt__(self, other):
         return self.fitness() < other.fitness()
 
+    def __eq__(self, other):
+        # Interned genomes are equal exactly when they share the same list.
+        # Genomes are interned when they are built for the population and
+        # after every mutation, not here.
+        if not isinstance(other, Genome):
+            return False
+        return self.operations is other.operations and self.genome is other.genome
+
+    def __hash__(self):
+        return id(self.genome)
+
     def __str__(self):
         return str(self.genome)
     
@@ -774,6 +1216,797 @@ SAGE_OPERATIONS = [
     Divide()
 ]
 
+class Traced(Operation):
+    # Runs an operation, and counts how many times the gene it was decoded
+    # from has run. It is not a step of its own.
+    def __init__(self, operation, path, counts):
+        self.operation = operation
+        self.path = path
+        self.counts = counts
+
+    def checked_apply(self, tape):
+        self.counts[self.path] += 1
+        self.operation.checked_apply(tape)
+
+    def __str__(self):
+        return str(self.operation)
+
+class ExecutionTrace:
+    # How many times every gene of a genome ran while its fitness was
+    # computed, keyed by the path of the gene. A block is counted at its
+    # first gene. `run` decodes the genome again without the decode cache,
+    # with every operation wrapped so it counts its own gene.
+    def __init__(self, genome, counts=None, age=0):
+        self.operations = genome.operations
+        self.genome = genome.genome
+        self.counts = Counter() if counts is None else Counter(counts)
+        # The number of edit scripts the counts were carried over, see `edited`.
+        self.age = age
+
+    def run(self, fitness_function):
+        # Returns the fitness of the genome, counting the genes that ran.
+        return fitness_function(TracedGenome(self))
+
+    def edited(self, genome):
+        # An approximate trace of a child of the traced genome, without
+        # running it: the counts are moved along with the genes the child's
+        # edits shift, the counts of removed genes are dropped, and inserted
+        # genes have none.
+        counts = self.counts
+        for path, operation, value in genome.edits:
+            if operation == REPLACE:
+                continue
+            depth = len(path) - 1
+            moved = Counter()
+            for key, executions in counts.items():
+                if len(key) <= depth or key[:depth] != path[:depth] or key[depth] < path[-1]:
+                    moved[key] = executions
+                elif operation == INSERT:
+                    moved[key[:depth] + (key[depth] + 1,) + key[depth + 1:]] = executions
+                elif key[depth] > path[-1]:
+                    moved[key[:depth] + (key[depth] - 1,) + key[depth + 1:]] = executions
+            counts = moved
+        return ExecutionTrace(genome, counts, self.age + 1)
+
+    def executions(self, path):
+        # Genes that are not decoded into an operation of their own, like
+        # immediates, function names and the end of a block, take the count
+        # of the block they are in.
+        while path:
+            if path in self.counts:
+                return self.counts[path]
+            head = path[:-1] + (0,)
+            if head in self.counts:
+                return self.counts[head]
+            path = path[:-1]
+        return 0
+
+    def decode(self, genes, path, start=0):
+        operations = []
+        for i in range(start, len(genes)):
+            gene = genes[i]
+            if type(gene) == list:
+                operations.extend(self.decode_block(gene, path + (i,)))
+            else:
+                if gene >= len(self.operations):
+                    raise IndexError(f"Operation index {gene} is out of range")
+                operations.append(Traced(self.operations[gene], path + (i,), self.counts))
+        return operations
+
+    def decode_block(self, genes, path):
+        # Follows `Genome.decode_block`.
+        if len(genes) == 0:
+            return []
+        if type(genes[0]) == list:
+            return self.decode(genes[0], path + (0,)) + self.decode(genes, path, 1)
+        operation_type = type(self.operations[genes[0]])
+        head = path + (0,)
+        if operation_type in [WhileLoop, If]:
+            operation = operation_type(self.decode(genes, path, 1))
+        elif operation_type in [MoveRight, MoveLeft]:
+            operation = operation_type(genes[1])
+        elif operation_type == SetRegister:
+            if len(genes) != 2:
+                raise Exception('SetRegister with no value')
+            operation = SetRegister(genes[1])
+        elif operation_type == IfElse:
+            if len(genes) != 3:
+                raise Exception('IfElse with no value')
+            operation = IfElse(self.decode(genes[1], path + (1,)), self.decode(genes[2], path + (2,)))
+        elif operation_type == Function:
+            operation = Function(int(genes[1]), self.decode(genes, path, 2))
+        else:
+            return self.decode(genes, path)
+        return [Traced(operation, head, self.counts)]
+
+class TracedGenome(Genome):
+    # The genome a fitness function is given by `ExecutionTrace`.
+    def __init__(self, trace):
+        super().__init__(trace.operations, trace.genome)
+        self.trace = trace
+
+    def into_operations(self):
+        return self.trace.decode(self.genome, ())
+
+# Reasons a genome can be rejected by the static pre-filter.
+UNDECODABLE = 'undecodable'
+UNDEFINED_CALL = 'undefined call'
+NO_OUTPUT = 'no output'
+
+class StaticFilter:
+    # A cheap pass over the genes that finds genomes which are certain to
+    # score zero, without decoding, copying or running them. It follows
+    # the same rules as `Genome.into_operations`.
+    def __init__(self, require_output=True):
+        self.require_output = require_output
+        self.checked = 0
+        self.rejected = {UNDECODABLE: 0, UNDEFINED_CALL: 0, NO_OUTPUT: 0}
+
+    def classify(self, genome):
+        # Returns the reason the genome is rejected, or None if it has to be run.
+        state = {'functions': 0, 'output': False, 'undefined_call': False}
+        if not self.scan(genome.genome, genome.operations, True, state):
+            return UNDECODABLE
+        if state['undefined_call']:
+            return UNDEFINED_CALL
+        if self.require_output and not state['output']:
+            return NO_OUTPUT
+        return None
+
+    def scan(self, genes, operations, top_level, state):
+        # `top_level` is true while every operation in `genes` is certain to
+        # run, so a call there with no function defined before it always fails.
+        for gene in genes:
+            if type(gene) == list:
+                if len(gene) == 0:
+                    continue
+                if type(gene[0]) == list:
+                    if not self.scan(gene[0], operations, top_level, state) or not self.scan(gene[1:], operations, top_level, state):
+                        return False
+                    continue
+                try:
+                    operation_type = type(operations[gene[0]])
+                except (IndexError, TypeError):
+                    return False
+
+                if operation_type in [WhileLoop, If]:
+                    if not self.scan(gene[1:], operations, False, state):
+                        return False
+                elif operation_type in [MoveRight, MoveLeft]:
+                    if len(gene) < 2:
+                        return False
+                elif operation_type == SetRegister:
+                    if len(gene) != 2:
+                        return False
+                elif operation_type == IfElse:
+                    if len(gene) != 3 or type(gene[1]) != list or type(gene[2]) != list:
+                        return False
+                    if not self.scan(gene[1], operations, False, state) or not self.scan(gene[2], operations, False, state):
+                        return False
+                elif operation_type == Function:
+                    if len(gene) < 2 or type(gene[1]) == list:
+                        return False
+                    state['functions'] += 1
+                    if not self.scan(gene[2:], operations, False, state):
+                        return False
+                else:
+                    if not self.scan(gene, operations, top_level, state):
+                        return False
+            else:
+                if gene >= len(operations) or gene < -len(operations):
+                    return False
+                operation_type = type(operations[gene])
+                if operation_type in [PutInt, PutChar]:
+                    state['output'] = True
+                elif operation_type == Call and top_level and state['functions'] == 0:
+                    state['undefined_call'] = True
+        return True
+
+    def reject(self, genome):
+        self.checked += 1
+        reason = self.classify(genome)
+        if reason is not None:
+            self.rejected[reason] += 1
+            return True
+        return False
+
+    def __str__(self):
+        total = sum(self.rejected.values())
+        reasons = ', '.join(f'{reason}: {count}' for reason, count in self.rejected.items())
+        return f'rejected {total}/{self.checked} ({reasons})'
+
+# The surrogate pre-filter is retrained on at most this many of the latest
+# evaluated children.
+SURROGATE_MEMORY = 20000
+# Children are only skipped once the surrogate has seen this many of them,
+# and at least this many of both working and broken ones.
+SURROGATE_WARMUP = 500
+SURROGATE_MIN_CLASS = 20
+# The L2 penalty on the weights of the surrogate, and the number of Newton
+# steps of every retraining.
+SURROGATE_PENALTY = 1.0
+SURROGATE_STEPS = 5
+
+# A parent's execution counts are carried over from its own parent's for
+# at most this many generations before it is traced again.
+TRACE_GENERATIONS = 10
+
+def trace_parents(parents, traces, pool=None):
+    # Returns the execution trace of every parent, by id. A trace is carried
+    # over from the parent's own parent if that was traced, and only the
+    # other parents are run, in the workers of the pool if there is one.
+    # `traces` are the traces of the last generation of parents.
+    result = {}
+    new = []
+    for parent in parents:
+        if parent.id in traces:
+            result[parent.id] = traces[parent.id]
+        elif parent.parent_id in traces and parent.edits is not None and traces[parent.parent_id].age < TRACE_GENERATIONS:
+            result[parent.id] = traces[parent.parent_id].edited(parent)
+        else:
+            new.append(parent)
+    if pool is not None and len(new) > 0:
+        new_traces = pool.trace(new)
+    else:
+        new_traces = []
+        for parent in new:
+            trace = ExecutionTrace(parent)
+            trace.run(parent.fitness_function)
+            new_traces.append(trace)
+    for parent, trace in zip(new, new_traces):
+        if trace is not None:
+            result[parent.id] = trace
+    return result
+
+# Operations that shuffle the head and the dereference stack around. Runs
+# of them are often redundant, see `SiteProfile`.
+SHUFFLE_OPERATIONS = (MoveLeft, MoveRight, Dereference, Reference)
+
+class SiteWeights:
+    # The site weights of one block of a genome: the heat of its plain
+    # genes, the weights of its sub-lists, and the running total of the
+    # weights of its genes, like `gene_counts`. The heat of a gene that was
+    # not traced is `fallback`, the count of the block it is in. Weights are
+    # shared by a parent and its children, so once weighed they are copied
+    # rather than changed.
+    def __init__(self, genes, heat, children, fallback):
+        self.genes = genes
+        self.heat = heat
+        self.children = children
+        self.fallback = fallback
+        self.sequence = None
+        self.redundant = None
+        self.totals = None
+
+    def copy(self, genes):
+        return SiteWeights(genes, list(self.heat), list(self.children), self.fallback)
+
+class SiteProfile:
+    # Weights the mutation sites of the children of a traced parent. Every
+    # plain gene weighs 1, plus `hot_weight` times how hot it is, and plus
+    # `redundant_weight` if it is part of a run of shuffle operations. A
+    # gene is as hot as the log of its executions, scaled so the hottest
+    # gene of the parent is 1.
+    #
+    # The weights of a child are derived from the parent's along its edit
+    # script, like `update_counts` does for gene counts: an edit copies the
+    # `SiteWeights` of the blocks on its path, and the parent's counts are
+    # carried over like `ExecutionTrace.edited` does.
+    def __init__(self, trace, hot_weight=1.0, redundant_weight=1.0):
+        self.trace = trace
+        self.hot_weight = hot_weight
+        self.redundant_weight = redundant_weight
+        self.parent_weights = None
+        self.hottest = 0.0
+        # The weights of the child that is being mutated.
+        self.child_weights = None
+
+    def site(self, genome):
+        # A path to a plain gene of the genome, or None if it has none. Every
+        # block on the way down is picked by its share of the weight.
+        weights = self.weights(genome)
+        path = ()
+        while True:
+            totals = weights.totals
+            if not totals or totals[-1] <= 0.0:
+                return None
+            i = bisect_right(totals, random.random() * totals[-1])
+            if i == len(totals):
+                i = bisect_left(totals, totals[-1])
+            path += (i,)
+            if weights.children[i] is None:
+                return path
+            weights = weights.children[i]
+
+    def weights(self, genome):
+        if genome.genome is self.trace.genome:
+            return self.parent(genome)
+        self.parent(genome)
+        if self.child_weights is not None and self.child_weights.genes is genome.genome:
+            return self.child_weights
+        # A child that was not edited through `Genome.edit`.
+        return self.weigh(genome, self.measure(self.trace.edited(genome), genome.genome, ()), True, False)
+
+    def parent(self, genome):
+        # The parent's weights, which are kept for all of its children. The
+        # parent is measured first, since it sets how hot the hottest gene is.
+        if self.parent_weights is None:
+            self.parent_weights = self.weigh(genome, self.measure(self.trace, self.trace.genome, ()), True, False)
+        return self.parent_weights
+
+    def measure(self, trace, genes, path):
+        # The unweighed site weights of the block at `path`, with the heat of
+        # its genes in the trace.
+        heat = []
+        children = []
+        for i, gene in enumerate(genes):
+            if type(gene) == list:
+                heat.append(None)
+                children.append(self.measure(trace, gene, path + (i,)))
+            else:
+                hot = math.log1p(trace.executions(path + (i,)))
+                if trace is self.trace:
+                    self.hottest = max(self.hottest, hot)
+                heat.append(hot)
+                children.append(None)
+        # No gene is at the end of the block, so this is the count of the
+        # block.
+        fallback = math.log1p(trace.executions(path + (len(genes),)))
+        return SiteWeights(genes, heat, children, fallback)
+
+    def fresh(self, gene, heat):
+        # The site weights of a gene that was added by an edit, or None for
+        # a plain gene.
+        if type(gene) != list:
+            return None
+        return SiteWeights(gene, [None if type(g) == list else heat for g in gene], [self.fresh(g, heat) for g in gene], heat)
+
+    def edited(self, genome, old_genome, path, operation, value):
+        # Derives the weights of the genome from those of `old_genome`, of
+        # which it is an edit. Only the blocks along the path are weighed
+        # again, and the blocks next to them if their context changed.
+        if old_genome is self.trace.genome:
+            old = self.parent(genome)
+        elif self.child_weights is not None and self.child_weights.genes is old_genome:
+            old = self.child_weights
+        else:
+            self.child_weights = None
+            return
+        old_blocks = [old]
+        new_blocks = [genome.genome]
+        for index in path[:-1]:
+            old_blocks.append(old_blocks[-1].children[index])
+            new_blocks.append(new_blocks[-1][index])
+        block = old_blocks[-1].copy(new_blocks[-1])
+        i = path[-1]
+        if operation == INSERT:
+            block.heat.insert(i, block.fallback)
+            block.children.insert(i, self.fresh(value, block.fallback))
+        elif operation == REMOVE:
+            del block.heat[i]
+            del block.children[i]
+        else:
+            hot = block.heat[i] if block.children[i] is None else block.fallback
+            block.heat[i] = hot
+            block.children[i] = self.fresh(value, hot)
+        for depth in reversed(range(len(path) - 1)):
+            parent = old_blocks[depth].copy(new_blocks[depth])
+            parent.children[path[depth]] = block
+            block = parent
+        self.child_weights = self.weigh(genome, block, True, False)
+
+    def weigh(self, genome, weights, sequence, redundant):
+        # The weights with their running totals, in the context of the block
+        # they are in. The genes that give a block its shape are as redundant
+        # as the block, the others by whether a neighbour is also a shuffle.
+        if weights.totals is not None:
+            if weights.sequence == sequence and weights.redundant == redundant:
+                return weights
+            weights = weights.copy(weights.genes)
+        weights.sequence = sequence
+        weights.redundant = redundant
+        genes = weights.genes
+        if sequence:
+            first = 0
+            kind = None
+        else:
+            kind = genome.block_kind(genes)
+            first = 1 if kind is None else FIRST_FREE_GENE[kind]
+        totals = []
+        total = 0.0
+        for i, gene in enumerate(genes):
+            free = first is not None and i >= first
+            gene_redundant = redundant
+            if free:
+                gene_redundant = self.is_shuffle(genome, gene) and (
+                    (i > first and self.is_shuffle(genome, genes[i - 1])) or
+                    (i + 1 < len(genes) and self.is_shuffle(genome, genes[i + 1])))
+            if type(gene) == list:
+                gene_sequence = not sequence and ((kind is None and i == 0) or kind == IF_ELSE_BLOCK)
+                child = self.weigh(genome, weights.children[i], gene_sequence, gene_redundant)
+                weights.children[i] = child
+                if child.totals:
+                    total += child.totals[-1]
+            else:
+                total += 1.0 + self.redundant_weight * gene_redundant
+                if self.hottest > 0.0:
+                    total += self.hot_weight * weights.heat[i] / self.hottest
+            totals.append(total)
+        weights.totals = totals
+        return weights
+
+    def is_shuffle(self, genome, gene):
+        if type(gene) == list:
+            if len(gene) == 0 or type(gene[0]) == list:
+                return False
+            gene = gene[0]
+        return 0 <= gene < len(genome.operations) and isinstance(genome.operations[gene], SHUFFLE_OPERATIONS)
+
+class SurrogateFilter:
+    # A learned pre-filter for children of the current parents. It predicts
+    # from a child's edit script whether the child is broken, with a
+    # logistic regression trained on the children that were run. Features
+    # are the kinds of edits, how deep they are, the operations they remove
+    # and add, and whether the parent ran the edited genes.
+    #
+    # A child is skipped, and scored 0, only if it is predicted to be broken
+    # with the given confidence. A fraction of those children is run anyway,
+    # so the model keeps learning from its own mistakes.
+    def __init__(self, operations, confidence=0.95, exploration=0.1):
+        self.operations = operations
+        self.confidence = confidence
+        self.exploration = exploration
+        # The execution traces of the current parents, see `trace_parents`.
+        self.traces = {}
+        self.features = {}
+        self.explored = set()
+        self.samples = deque(maxlen=SURROGATE_MEMORY)
+        self.weights = None
+        self.checked = 0
+        self.skipped = 0
+        self.explored_count = 0
+        self.explored_working = 0
+
+    def feature_count(self):
+        return 8 + 2 * len(self.operations)
+
+    def encode(self, genome):
+        # The features of a child of one of the parents, or None. They are a
+        # bias, the numbers of insertions, removals and replacements, the
+        # mean depth of the edits, the numbers of edits to genes the parent
+        # did and did not run, the number of changed immediates and names,
+        # and how many times every operation was removed and added.
+        trace = self.traces.get(genome.parent_id)
+        if trace is None or not genome.edits:
+            return None
+        features = np.zeros(self.feature_count())
+        features[0] = 1.0
+        kinds = {INSERT: 1, REMOVE: 2, REPLACE: 3}
+        current = Genome(self.operations, trace.genome)
+        removed = 8
+        added = 8 + len(self.operations)
+        for path, operation, value in genome.edits:
+            features[kinds[operation]] += 1
+            features[4] += len(path) / len(genome.edits)
+            if trace.executions(path) > 0:
+                features[5] += 1
+            else:
+                features[6] += 1
+            changes_operation = True
+            if operation != INSERT:
+                old = get_block(current.genome, path)
+                if type(old) != list and current.gene_role(path)[0] not in (OPERATION_GENE, HEAD_GENE):
+                    # An immediate or a function name.
+                    features[7] += 1
+                    changes_operation = False
+                else:
+                    self.count_operation(features, removed, old)
+            if operation != REMOVE and changes_operation:
+                self.count_operation(features, added, value)
+            current.genome = apply_edit(current.genome, path, operation, value)
+        return features
+
+    def count_operation(self, features, offset, gene):
+        # A block is counted by its first gene.
+        if type(gene) == list:
+            if len(gene) == 0 or type(gene[0]) == list:
+                return
+            gene = gene[0]
+        if 0 <= gene < len(self.operations):
+            features[offset + gene] += 1
+
+    def probability(self, features):
+        # The predicted probability that a child works.
+        return 1.0 / (1.0 + math.exp(-max(-50.0, min(50.0, float(features @ self.weights)))))
+
+    def reject(self, genome):
+        features = self.encode(genome)
+        if features is None:
+            return False
+        self.checked += 1
+        self.features[genome.id] = features
+        if self.weights is None or self.probability(features) >= 1.0 - self.confidence:
+            return False
+        if random.random() < self.exploration:
+            self.explored.add(genome.id)
+            return False
+        del self.features[genome.id]
+        self.skipped += 1
+        return True
+
+    def learn(self, genomes):
+        # Adds the children that were run to the training set, and retrains
+        # the model from its last weights.
+        for genome in genomes:
+            features = self.features.pop(genome.id, None)
+            if features is None:
+                continue
+            working = genome._fitness is not None and genome._fitness > 0.0
+            self.samples.append((features, working))
+            if genome.id in self.explored:
+                self.explored.remove(genome.id)
+                self.explored_count += 1
+                self.explored_working += working
+        self.features.clear()
+        self.explored.clear()
+        self.train()
+
+    def train(self):
+        working = sum(label for _, label in self.samples)
+        if len(self.samples) < SURROGATE_WARMUP or min(working, len(self.samples) - working) < SURROGATE_MIN_CLASS:
+            return
+        x = np.array([features for features, _ in self.samples])
+        y = np.array([label for _, label in self.samples], dtype=float)
+        weights = np.zeros(x.shape[1]) if self.weights is None else self.weights
+        penalty = SURROGATE_PENALTY * np.eye(x.shape[1])
+        penalty[0, 0] = 0.0
+        for _ in range(SURROGATE_STEPS):
+            p = 1.0 / (1.0 + np.exp(-np.clip(x @ weights, -50.0, 50.0)))
+            gradient = x.T @ (p - y) + penalty @ weights
+            hessian = (x.T * (p * (1.0 - p))) @ x + penalty
+            weights = weights - np.linalg.solve(hessian, gradient)
+        self.weights = weights
+
+    def __str__(self):
+        explored = f'{self.explored_working}/{self.explored_count}'
+        return f'skipped {self.skipped}/{self.checked} (explored skips that worked: {explored})'
+
+# Outcomes of a child, compared with its parent.
+IMPROVED = 'improved'
+NEUTRAL = 'neutral'
+WORSE = 'worse'
+BROKEN = 'broken'
+# The reward the scheduler gives a neutral child. Improvements are rare
+# while a program shrinks, and neutral children keep the search moving.
+NEUTRAL_REWARD = 0.1
+# How much of an operator's reward comes from the latest generation.
+OPERATOR_DECAY = 0.3
+# Every operator is picked with at least this probability, so one that
+# stopped working early can come back later.
+OPERATOR_FLOOR = 0.05
+
+class OperatorScheduler:
+    # Keeps how many of the children of every mutation operator improved
+    # on their parent, did as well, did worse, or were broken. If it is
+    # adaptive, it also picks the operator of every child, by probability
+    # matching on a decayed reward per operator, so the mix shifts towards
+    # the operators that work at this point of the run. Removals tend to
+    # win early on, and swaps later.
+    def __init__(self, operators, adaptive=True):
+        self.operators = operators
+        self.adaptive = adaptive
+        self.counts = {operator: Counter() for operator in operators}
+        self.rewards = {operator: 1.0 for operator in operators}
+        self.probabilities = [1.0 / len(operators)] * len(operators)
+
+    def choose(self):
+        # The operator of the next child, or None for the default mix.
+        if not self.adaptive:
+            return None
+        return random.choices(self.operators, self.probabilities)[0]
+
+    def outcome(self, child, parent_fitness):
+        fitness = child.fitness()
+        if fitness <= 0.0:
+            return BROKEN
+        if fitness > parent_fitness:
+            return IMPROVED
+        if fitness == parent_fitness:
+            return NEUTRAL
+        return WORSE
+
+    def record(self, parents, children):
+        # Counts the outcomes of the children of the parents, and updates the
+        # probabilities. Children skipped by a pre-filter count as broken, and
+        # children the operator did not change are not counted.
+        parents = {parent.id: parent for parent in parents}
+        outcomes = {operator: Counter() for operator in self.operators}
+        for child in children:
+            parent = parents.get(child.parent_id)
+            if child.operator not in outcomes or parent is None or child == parent:
+                continue
+            outcomes[child.operator][self.outcome(child, parent.fitness())] += 1
+        for operator, counts in outcomes.items():
+            self.counts[operator].update(counts)
+            total = sum(counts.values())
+            if total > 0:
+                reward = (counts[IMPROVED] + NEUTRAL_REWARD * counts[NEUTRAL]) / total
+                self.rewards[operator] += OPERATOR_DECAY * (reward - self.rewards[operator])
+        total = sum(self.rewards.values())
+        share = 1.0 - OPERATOR_FLOOR * len(self.operators)
+        self.probabilities = [OPERATOR_FLOOR + share * (self.rewards[operator] / total if total > 0 else 1.0 / len(self.operators)) for operator in self.operators]
+
+    def __str__(self):
+        operators = []
+        for operator, probability in zip(self.operators, self.probabilities):
+            counts = self.counts[operator]
+            outcomes = '/'.join(str(counts[outcome]) for outcome in (IMPROVED, NEUTRAL, WORSE, BROKEN))
+            if self.adaptive:
+                operators.append(f'{operator} {outcomes} ({probability:.2f})')
+            else:
+                operators.append(f'{operator} {outcomes}')
+        return 'improved/neutral/worse/broken: ' + ', '.join(operators)
+
+# Operations that only read and write the tape, the head, the register and
+# the dereference stack. Two sequences of them can be compared by running
+# them on the same random tapes.
+PURE_OPERATIONS = [SetRegister, MoveLeft, MoveRight, Dereference, Reference, Save, Restore, Index, Where, IsNonNegative, Add, Subtract, Multiply, Divide]
+
+class Superoptimizer:
+    # Slides a window over every block of a genome, and replaces the window
+    # with a shorter sequence of operations that does the same thing.
+    #
+    # Every sequence of up to `window - 1` operations is run once on a fixed
+    # set of random tapes, and indexed by the states it leaves them in. A
+    # window is run on the same tapes, and the sequences with the same final
+    # states are the candidates to replace it. A candidate is only accepted
+    # if the whole genome still scores at least as well on the test suite.
+    def __init__(self, operations, window=3, samples=16, max_move=16, seed=0):
+        self.operations = operations
+        self.window = window
+        self.accepted = 0
+        self.tried = 0
+
+        rng = random.Random(seed)
+        self.states = []
+        for _ in range(samples):
+            tape = Tape(64)
+            tape.tape = [rng.randint(0, 63) for _ in range(64)]
+            tape.head_position = rng.randint(8, 55)
+            tape.register = rng.randint(-4, 63)
+            tape.deref_stack = [rng.randint(8, 55) for _ in range(2)]
+            self.states.append(tape)
+
+        # The alphabet is every distinct pure operation in the operation set,
+        # and head moves by up to `max_move` cells.
+        alphabet = []
+        seen = set()
+        for index, operation in enumerate(operations):
+            if type(operation) in PURE_OPERATIONS and str(operation) not in seen:
+                seen.add(str(operation))
+                alphabet.append(index)
+        for index, operation in enumerate(operations):
+            if type(operation) in [MoveLeft, MoveRight]:
+                alphabet.extend([index, steps] for steps in range(2, max_move + 1))
+
+        self.candidates = {}
+        for length in range(window):
+            for sequence in product(alphabet, repeat=length):
+                key = self.fingerprint(self.decode(sequence))
+                self.candidates.setdefault(key, []).append(list(sequence))
+
+    def is_instruction(self, gene):
+        # A single pure operation, either a plain gene or an operation with
+        # an immediate operand.
+        if type(gene) == list:
+            return len(gene) == 2 and type(gene[0]) == int and type(gene[1]) == int and -len(self.operations) <= gene[0] < len(self.operations) and type(self.operations[gene[0]]) in [MoveLeft, MoveRight, SetRegister]
+        return -len(self.operations) <= gene < len(self.operations) and type(self.operations[gene]) in PURE_OPERATIONS
+
+    def decode(self, genes):
+        return Genome(self.operations, list(genes)).into_operations()
+
+    def fingerprint(self, operations):
+        result = []
+        for state in self.states:
+            tape = Tape(0)
+            tape.tape = list(state.tape)
+            tape.head_position = state.head_position
+            tape.register = state.register
+            tape.deref_stack = list(state.deref_stack)
+            try:
+                for operation in operations:
+                    operation.apply(tape)
+            except Exception as e:
+                result.append(type(e).__name__)
+                continue
+            # Reading past the end of the tape grows it with blanks, which
+            # does not change what the program sees.
+            cells = tape.tape
+            while cells and cells[-1] == tape.blank_symbol:
+                cells = cells[:-1]
+            result.append((tuple(cells), tape.head_position, tape.register, tuple(tape.deref_stack)))
+        return tuple(result)
+
+    def blocks(self, genes, path=(), start=0):
+        # Yields the path to every list of operations in the genome, and the
+        # index where its operations start. Inner blocks come before the
+        # blocks that contain them, so shrinking a block never moves a block
+        # that has not been visited yet.
+        for i in range(start, len(genes)):
+            gene = genes[i]
+            if type(gene) != list or len(gene) == 0 or self.is_instruction(gene):
+                continue
+            if type(gene[0]) == list:
+                yield from self.blocks(gene[0], path + (i, 0))
+                yield path + (i, 0), 0
+                yield from self.blocks(gene, path + (i,), 1)
+                yield path + (i,), 1
+                continue
+            if type(gene[0]) != int or not -len(self.operations) <= gene[0] < len(self.operations):
+                continue
+            operation_type = type(self.operations[gene[0]])
+            if operation_type == IfElse:
+                if len(gene) == 3:
+                    for branch in [1, 2]:
+                        if type(gene[branch]) == list:
+                            yield from self.blocks(gene[branch], path + (i, branch))
+                            yield path + (i, branch), 0
+            elif operation_type in [WhileLoop, If]:
+                yield from self.blocks(gene, path + (i,), 1)
+                yield path + (i,), 1
+            elif operation_type == Function:
+                yield from self.blocks(gene, path + (i,), 2)
+                yield path + (i,), 2
+            elif operation_type not in [MoveLeft, MoveRight, SetRegister]:
+                yield from self.blocks(gene, path + (i,))
+                yield path + (i,), 0
+
+    def optimize(self, genome, fitness_function):
+        genes = genome.genome
+        best = fitness_function(Genome(self.operations, genes))
+        if best <= 0:
+            return genome
+
+        for path, start in list(self.blocks(genes)) + [((), 0)]:
+            i = start
+            while True:
+                block = get_block(genes, path)
+                if i >= len(block):
+                    break
+                accepted = False
+                for size in range(self.window, 1, -1):
+                    window = block[i:i + size]
+                    if len(window) < size or not all(self.is_instruction(gene) for gene in window):
+                        continue
+                    key = self.fingerprint(self.decode(window))
+                    for candidate in self.candidates.get(key, []):
+                        if len(candidate) >= size:
+                            break
+                        self.tried += 1
+                        new_genes = replace_block(genes, path, i, i + size, deepcopy(candidate))
+                        fitness = fitness_function(Genome(self.operations, new_genes))
+                        if fitness > 0 and fitness >= best:
+                            genes, best, accepted = new_genes, fitness, True
+                            self.accepted += 1
+                            break
+                    if accepted:
+                        break
+                # Stay on the same position after a replacement, the new
+                # operations may shrink further with their neighbours.
+                if not accepted:
+                    i += 1
+
+        return Genome(self.operations, genes, fitness_function=genome.fitness_function).intern()
+
+def replace_block(genes, path, start, stop, replacement):
+    # Returns a copy of the genes with `block[start:stop]` replaced, where
+    # `block` is the list at `path`. Only the lists along the path are copied.
+    if len(path) == 0:
+        return genes[:start] + replacement + genes[stop:]
+    result = list(genes)
+    result[path[0]] = replace_block(genes[path[0]], path[1:], start, stop, replacement)
+    return result
+
 def how_sorted_is_list(l, total=100):
     # Pick a bunch of random i, j values
     # and see how many times i < j
@@ -794,7 +2027,13 @@ def how_sorted_is_list(l, total=100):
             count -= 1
     return count / total
 
-def sorted_fitness_function(genome):
+def program_cost(genome, steps, runtime_weight=0.0):
+    # The cost the optimizer minimizes. With a runtime weight, every executed
+    # step across the test suite costs that fraction of an instruction, so the
+    # optimizer makes programs faster as well as smaller.
+    return genome.get_size() + runtime_weight * steps
+
+def sorted_fitness_function(genome, runtime_weight=0.0):
     # Create several lists of differing lengths, testing sizes 0, 1, ..., 10
     # and see how sorted they are.
     lists = []
@@ -803,93 +2042,615 @@ def sorted_fitness_function(genome):
         lists.append([random.randint(0, 100) for _ in range(i)])
 
     fitness = 0.0
+    steps = 0
     for l in lists:
         input_list = [len(l)]
         input_list.extend(l)
 
         try:
             tm = genome.evaluate(input_list, max_steps=30000)
+            steps += tm.steps
             fitness += how_sorted_is_list(tm.output) * 50.0
             l.sort()
             if tm.output != l:
                 fitness = 0.0
                 break
+        except MemoryError:
+            # A fault of the sandbox, see `SANDBOX`.
+            if SANDBOX['active']:
+                raise
+            fitness = 0.0
+            break
         except Exception as e:
             fitness = 0.0
             break
 
-    return fitness / genome.get_size()
+    return fitness / program_cost(genome, steps, runtime_weight)
 
-def factorial_fitness_function(genome):
+def factorial_fitness_function(genome, runtime_weight=0.0):
     # Create several lists of differing lengths, testing sizes 0, 1, ..., 10
     # and see how sorted they are.
     fitness = 0.0
+    steps = 0
     for i in range(0, 15):
         try:
             tm = genome.evaluate([int(i)], 5000)
+            steps += tm.steps
             if tm.output == [math.factorial(i)]:
                 fitness += 1.0
             else:
                 fitness = 0.0
                 break
-        except:
+        except MemoryError:
+            if SANDBOX['active']:
+                raise
+            fitness = 0.0
+            break
+        except Exception:
             fitness = 0.0
             break
 
-    return fitness / genome.get_size()
+    return fitness / program_cost(genome, steps, runtime_weight)
 
 
 POPULATION_SIZE = 100
 
-def evolve_optimizations(path_to_vm_code, fitness_function, epochs=200):
+# Genomes are shared with worker processes through a table of gene lists
+# in shared memory. Every list is stored once, as pairs of tokens: a plain
+# gene and its value, or a nested list and its index in the table.
+GENE_TOKEN = 0
+BLOCK_TOKEN = 1
+# The most tokens the table holds before it is started over.
+TABLE_TOKENS = 1 << 23
+
+def arena_arrays(memory, sizes):
+    # The arrays in a shared memory arena: the table index of the genes of
+    # every genome in the batch, the fitness of every genome, the offsets of
+    # the tokens of every gene list, and the tokens.
+    genome_capacity, block_capacity, token_capacity = sizes
+    roots = np.ndarray((genome_capacity,), dtype=np.int64, buffer=memory.buf)
+    fitnesses = np.ndarray((genome_capacity,), dtype=np.float64, buffer=memory.buf, offset=8 * genome_capacity)
+    offsets = np.ndarray((block_capacity + 1,), dtype=np.int64, buffer=memory.buf, offset=16 * genome_capacity)
+    tokens = np.ndarray((token_capacity,), dtype=np.int64, buffer=memory.buf, offset=8 * (2 * genome_capacity + block_capacity + 1))
+    return roots, fitnesses, offsets, tokens
+
+# The state of a worker process of a `SharedPopulation`.
+SHARED_WORKER = {}
+
+def init_shared_worker(fitness_function, operations):
+    SHARED_WORKER['fitness_function'] = fitness_function
+    SHARED_WORKER['operations'] = operations
+    SHARED_WORKER['memory'] = None
+    SHARED_WORKER['generation'] = None
+
+def attach_arena(name, generation):
+    # Workers stay attached to the arena until it has to grow, and keep the
+    # gene lists they read until the table is started over.
+    memory = SHARED_WORKER['memory']
+    if memory is None or memory.name != name:
+        if memory is not None:
+            memory.close()
+        memory = shared_memory.SharedMemory(name=name)
+        SHARED_WORKER['memory'] = memory
+    if SHARED_WORKER['generation'] != generation:
+        SHARED_WORKER['generation'] = generation
+        SHARED_WORKER['blocks'] = {}
+    return memory
+
+def load_block(index, offsets, tokens, blocks):
+    # Every gene list is read once per worker. Lists shared between genomes
+    # are then the same list, so their decoded operations are reused too.
+    genes = blocks.get(index)
+    if genes is None:
+        values = tokens[offsets[index]:offsets[index + 1]].tolist()
+        genes = []
+        for i in range(0, len(values), 2):
+            if values[i] == BLOCK_TOKEN:
+                genes.append(load_block(values[i + 1], offsets, tokens, blocks))
+            else:
+                genes.append(values[i + 1])
+        blocks[index] = genes
+    return genes
+
+# Limits on a single evaluation in a sandboxed worker: seconds of CPU time,
+# and bytes of memory the worker may allocate beyond what it started with.
+# A worker that makes no progress for WATCHDOG_FACTOR times the time limit
+# is killed. A genome that breaks a limit scores FAULT_FITNESS.
+TIME_LIMIT = 10
+MEMORY_LIMIT = 2 << 30
+WATCHDOG_FACTOR = 2
+FAULT_FITNESS = 0.0
+
+class TimeLimitExceeded(BaseException):
+    # Not an Exception, so the fitness functions cannot mistake it for a
+    # broken program and return a fitness.
+    pass
+
+# Whether this process is a sandboxed worker. There, running out of memory
+# is a fault of the sandbox, which scores the genome, so the fitness
+# functions let MemoryError through. Elsewhere it only fails the program.
+SANDBOX = {'active': False}
+
+# Whether a SIGXCPU is meant for the genome being evaluated. The signal is
+# repeated every second once the limit is passed, and one that comes after
+# the genome is done must not kill the worker.
+CPU_LIMIT = {'armed': False}
+
+def raise_time_limit(signum, frame):
+    if CPU_LIMIT['armed']:
+        CPU_LIMIT['armed'] = False
+        raise TimeLimitExceeded()
+
+def address_space():
+    # The bytes of address space this process uses.
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+def limit_cpu_time(seconds):
+    # Sends SIGXCPU once this process has used `seconds` more CPU time.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    limit = math.ceil(usage.ru_utime + usage.ru_stime + seconds)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+    CPU_LIMIT['armed'] = True
+
+def disarm_cpu_time():
+    CPU_LIMIT['armed'] = False
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+def sandboxed_worker(connection, fitness_function, operations, time_limit, memory_limit):
+    # Runs in its own process. Receives ranges of genomes to evaluate from
+    # the arena, and sends back the index of every genome it finishes, with
+    # its execution counts if the task is traced.
+    init_shared_worker(fitness_function, operations)
+    SANDBOX['active'] = True
+    # A program that reads input it was not given gets end of file instead
+    # of blocking the worker.
+    sys.stdin = open(os.devnull)
+    if memory_limit is not None:
+        limit = address_space() + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    signal.signal(signal.SIGXCPU, raise_time_limit)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        name, sizes, generation, start, stop, traced = task
+        roots, fitnesses, offsets, tokens = arena_arrays(attach_arena(name, generation), sizes)
+        for i in range(start, stop):
+            genes = load_block(int(roots[i]), offsets, tokens, SHARED_WORKER['blocks'])
+            genome = Genome(SHARED_WORKER['operations'], genes, fitness_function=SHARED_WORKER['fitness_function'])
+            trace = ExecutionTrace(genome) if traced else None
+            if time_limit is not None:
+                limit_cpu_time(time_limit)
+            try:
+                if trace is None:
+                    fitnesses[i] = genome.fitness()
+                else:
+                    fitnesses[i] = trace.run(genome.fitness_function)
+            except (TimeLimitExceeded, MemoryError, RecursionError, EOFError):
+                fitnesses[i] = FAULT_FITNESS
+                trace = None
+            finally:
+                if time_limit is not None:
+                    disarm_cpu_time()
+            connection.send((i, None if trace is None else dict(trace.counts)))
+        del roots, fitnesses, offsets, tokens
+
+class SandboxedWorker:
+    def __init__(self, fitness_function, operations, time_limit, memory_limit):
+        self.connection, connection = Pipe()
+        self.process = Process(target=sandboxed_worker, args=(connection, fitness_function, operations, time_limit, memory_limit), daemon=True)
+        self.process.start()
+        connection.close()
+        # The task the worker is running, the next genome it will finish,
+        # and when it has to finish it by.
+        self.task = None
+        self.next = None
+        self.deadline = None
+
+    def send(self, task, timeout):
+        self.task = task
+        self.next = task[3]
+        self.deadline = None if timeout is None else time() + timeout
+        self.connection.send(task)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+class SharedPopulation:
+    # Evaluates genomes in sandboxed worker processes without pickling them.
+    # The gene lists of the genomes are written to a table in a shared memory
+    # arena, and every task only names a range of genomes in it. Children
+    # share all but a few lists with their parents, so each batch only adds
+    # the new lists to the table. Workers read their genomes straight from
+    # the arena and write their fitness back into it.
+    #
+    # Every evaluation in a worker is limited to `time_limit` seconds of CPU
+    # time and `memory_limit` more bytes of memory, and reads from an empty
+    # stdin. A watchdog kills and replaces workers that stop making progress,
+    # for example in a single huge multiplication. Genomes that break a
+    # limit are faults, and score FAULT_FITNESS.
+    def __init__(self, workers, fitness_function, operations, time_limit=TIME_LIMIT, memory_limit=MEMORY_LIMIT):
+        self.fitness_function = fitness_function
+        self.operations = operations
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.faults = 0
+        # Start the resource tracker before forking, so the workers share it
+        # and attaching to the arena from a worker never unlinks it.
+        resource_tracker.ensure_running()
+        self.workers = [self.start_worker() for _ in range(workers)]
+        self.memory = None
+        self.sizes = (0, 0, 0)
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        # Starts the table over.
+        self.block_ids = {}
+        # The lists in the table are kept alive, so their ids stay unique.
+        self.blocks = []
+        self.offsets = [0]
+        self.generation += 1
+
+    def add_block(self, genes, tokens):
+        # Returns the table index of the gene list, adding the list and its
+        # nested lists to the table if they are new.
+        index = self.block_ids.get(id(genes))
+        if index is not None:
+            return index
+        block = []
+        for gene in genes:
+            if type(gene) == list:
+                block.append(BLOCK_TOKEN)
+                block.append(self.add_block(gene, tokens))
+            else:
+                block.append(GENE_TOKEN)
+                block.append(gene)
+        tokens.extend(block)
+        self.offsets.append(self.offsets[-1] + len(block))
+        self.block_ids[id(genes)] = len(self.blocks)
+        self.blocks.append(genes)
+        return len(self.blocks) - 1
+
+    def reserve(self, sizes):
+        # Grows the arena to hold at least this many genomes, gene lists and
+        # tokens, keeping the table that is already in it.
+        if all(size <= capacity for size, capacity in zip(sizes, self.sizes)):
+            return
+        old_memory, old_sizes = self.memory, self.sizes
+        self.sizes = tuple(capacity if size <= capacity else max(size, 2 * capacity) for size, capacity in zip(sizes, self.sizes))
+        genome_capacity, block_capacity, token_capacity = self.sizes
+        self.memory = shared_memory.SharedMemory(create=True, size=8 * (2 * genome_capacity + block_capacity + 1 + token_capacity))
+        if old_memory is not None:
+            _, _, old_offsets, old_tokens = arena_arrays(old_memory, old_sizes)
+            _, _, offsets, tokens = arena_arrays(self.memory, self.sizes)
+            offsets[:len(old_offsets)] = old_offsets
+            tokens[:len(old_tokens)] = old_tokens
+            del old_offsets, old_tokens, offsets, tokens
+            old_memory.close()
+            old_memory.unlink()
+
+    def evaluate(self, genomes):
+        # Returns the fitness of every genome.
+        return self.submit(genomes, False)[0]
+
+    def trace(self, genomes):
+        # Returns an `ExecutionTrace` of every genome, or None for genomes
+        # that broke a limit.
+        counts = self.submit(genomes, True)[1]
+        return [None if genome_counts is None else ExecutionTrace(genome, genome_counts) for genome, genome_counts in zip(genomes, counts)]
+
+    def submit(self, genomes, traced):
+        # Runs the genomes in the workers, and returns their fitnesses and
+        # their execution counts.
+        if self.offsets[-1] > TABLE_TOKENS:
+            self.clear()
+        first_block = len(self.blocks)
+        first_token = self.offsets[-1]
+        new_tokens = []
+        genome_roots = [self.add_block(genome.genome, new_tokens) for genome in genomes]
+        self.reserve((len(genomes), len(self.blocks), self.offsets[-1]))
+
+        roots, fitnesses, offsets, tokens = arena_arrays(self.memory, self.sizes)
+        roots[:len(genomes)] = genome_roots
+        offsets[first_block:len(self.offsets)] = self.offsets[first_block:]
+        tokens[first_token:self.offsets[-1]] = new_tokens
+        size = max(1, len(genomes) // (4 * len(self.workers)))
+        tasks = [(self.memory.name, self.sizes, self.generation, start, min(start + size, len(genomes)), traced) for start in range(0, len(genomes), size)]
+        counts = [None] * len(genomes)
+        self.run(tasks, fitnesses, counts)
+        result = fitnesses[:len(genomes)].tolist()
+        # The arena can only be closed once no array refers to it.
+        del roots, fitnesses, offsets, tokens
+        return result, counts
+
+    def start_worker(self):
+        return SandboxedWorker(self.fitness_function, self.operations, self.time_limit, self.memory_limit)
+
+    def run(self, tasks, fitnesses, counts):
+        # Hands the tasks out to idle workers, and watches the busy ones.
+        tasks = deque(tasks)
+        idle = list(self.workers)
+        busy = {}
+        timeout = None if self.time_limit is None else WATCHDOG_FACTOR * self.time_limit
+        while tasks or busy:
+            while tasks and idle:
+                worker = idle.pop()
+                worker.send(tasks.popleft(), timeout)
+                busy[worker.connection] = worker
+
+            deadlines = [worker.deadline for worker in busy.values() if worker.deadline is not None]
+            wait_time = None if len(deadlines) == 0 else max(0.0, min(deadlines) - time())
+            for connection in wait(list(busy), wait_time):
+                worker = busy[connection]
+                try:
+                    index, genome_counts = connection.recv()
+                except (EOFError, OSError):
+                    # The worker died, most likely killed by a resource limit.
+                    del busy[connection]
+                    idle.append(self.replace_worker(worker, tasks, fitnesses))
+                    continue
+                counts[index] = genome_counts
+                worker.next = index + 1
+                if timeout is not None:
+                    worker.deadline = time() + timeout
+                if worker.next == worker.task[4]:
+                    del busy[connection]
+                    idle.append(worker)
+
+            for connection, worker in list(busy.items()):
+                if worker.deadline is None or time() <= worker.deadline:
+                    continue
+                # Genomes the worker finished while the others were being
+                # waited on are progress.
+                finished = worker.next
+                while worker.next < worker.task[4] and connection.poll():
+                    index, genome_counts = connection.recv()
+                    counts[index] = genome_counts
+                    worker.next = index + 1
+                if worker.next == worker.task[4]:
+                    del busy[connection]
+                    idle.append(worker)
+                elif worker.next > finished:
+                    worker.deadline = time() + timeout
+                else:
+                    del busy[connection]
+                    idle.append(self.replace_worker(worker, tasks, fitnesses))
+
+    def replace_worker(self, worker, tasks, fitnesses):
+        # Scores the genome a dead or hung worker was evaluating as a fault,
+        # puts the rest of its task back in the queue, and starts a new worker
+        # in its place.
+        worker.kill()
+        name, sizes, generation, start, stop, traced = worker.task
+        fitnesses[worker.next] = FAULT_FITNESS
+        self.faults += 1
+        if worker.next + 1 < stop:
+            tasks.appendleft((name, sizes, generation, worker.next + 1, stop, traced))
+        replacement = self.start_worker()
+        self.workers[self.workers.index(worker)] = replacement
+        return replacement
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+def evaluate_genomes(genomes, pool=None, prefilter=None, surrogate=None):
+    # Compute the fitness of every genome that has not been evaluated yet.
+    # With a `SharedPopulation`, the evaluations are fanned out over its
+    # workers, and the results are cached on the genomes in the parent process.
+    # Genomes the pre-filter or the surrogate rejects are scored 0 without
+    # being run, and duplicates of a genome are only run once.
+    known = {genome: genome._fitness for genome in genomes if genome._fitness is not None}
+    pending = []
+    duplicates = []
+    for genome in genomes:
+        if genome._fitness is not None:
+            continue
+        if genome in known:
+            duplicates.append(genome)
+        elif prefilter is not None and prefilter.reject(genome):
+            genome._fitness = 0.0
+            known[genome] = 0.0
+        elif surrogate is not None and surrogate.reject(genome):
+            genome._fitness = 0.0
+            known[genome] = 0.0
+        else:
+            pending.append(genome)
+            known[genome] = None
+    if pool is None or len(pending) == 0:
+        for genome in pending:
+            genome.fitness()
+    else:
+        for genome, fitness in zip(pending, pool.evaluate(pending)):
+            genome._fitness = fitness
+    for genome in pending:
+        known[genome] = genome._fitness
+    for genome in duplicates:
+        genome._fitness = known[genome]
+    if surrogate is not None:
+        surrogate.learn(pending)
+
+def save_checkpoint(path, epoch, genomes):
+    # A genome whose parent is also saved is stored as the index of its
+    # parent and its edit script. Parents are always older than their
+    # children, so saving the genomes in order of age saves parents first.
+    entries = []
+    saved = {}
+    for genome in sorted(genomes, key=lambda genome: genome.id):
+        if genome.edits is not None and genome.parent_id in saved:
+            entries.append((saved[genome.parent_id], genome.edits))
+        else:
+            entries.append((None, genome.genome))
+        saved[genome.id] = len(entries) - 1
+
+    # Write to a temporary file first so that an interrupted run never
+    # leaves a truncated checkpoint behind.
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({'epoch': epoch, 'genomes': entries}, f)
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(path):
+    with open(path, 'rb') as f:
+        checkpoint = pickle.load(f)
+    genomes = []
+    for parent, genes in checkpoint['genomes']:
+        if parent is None:
+            genomes.append(genes)
+        else:
+            genomes.append(apply_edits(genomes[parent], genes))
+    return checkpoint['epoch'], genomes
+
+def superoptimize_genome(superoptimizer, genome, fitness_function):
+    print('Superoptimizing...')
+    accepted = superoptimizer.accepted
+    result = superoptimizer.optimize(genome, fitness_function)
+    result.set_fitness_function(fitness_function)
+    print(f'Superoptimizer: {superoptimizer.accepted - accepted} replacements, program size: {genome.get_size()} -> {result.get_size()}')
+    return result
+
+def evolve_optimizations(path_to_vm_code, fitness_function, epochs=200, population_size=POPULATION_SIZE, workers=1, time_budget=None, checkpoint=None, output_dir='output', prefilter=True, runtime_weight=0.0, superoptimize=0, sandbox=None, time_limit=TIME_LIMIT, memory_limit=MEMORY_LIMIT, surrogate=False, exploration=0.1, adaptive_operators=False, hot_weight=0.0, redundant_weight=0.0):
     print(f'Evolving optimizations for \'{path_to_vm_code}\'...')
+    start_time = time()
     ops = parse(open(path_to_vm_code).read())[0]
-    
-    genomes = [Genome.from_operations(ops, SAGE_OPERATIONS) for _ in range(POPULATION_SIZE)]
+    survivors = max(population_size // 10, 1)
+    # A genome without output can only pass when no output is expected.
+    require_output = getattr(fitness_function, 'requires_output', True)
+    if runtime_weight:
+        fitness_function = partial(fitness_function, runtime_weight=runtime_weight)
+
+    genomes = [Genome.from_operations(ops, SAGE_OPERATIONS).intern() for _ in range(population_size)]
     old_genome_size = genomes[0].get_size()
+    first_epoch = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        print(f"Resuming from checkpoint '{checkpoint}'...")
+        first_epoch, saved = load_checkpoint(checkpoint)
+        genomes = [Genome(SAGE_OPERATIONS, genes).intern() for genes in saved]
     for genome in genomes:
         genome.set_fitness_function(fitness_function)
-    print("Sorting genomes...")
-    genomes.sort()
-    genomes = genomes[::-1]
-    print("Printing fitnesses...")
-    print(list(map(lambda g: g.fitness(), genomes)))
+
+    static_filter = StaticFilter(require_output) if prefilter else None
+    # The surrogate learns which children are broken, and skips the ones it
+    # is confident about, except for an `exploration` fraction of them.
+    surrogate_filter = SurrogateFilter(SAGE_OPERATIONS, exploration=exploration) if surrogate else None
+    # Every `superoptimize` epochs, and once at the end unless the last epoch
+    # already did, the best genome is shrunk further with the windowed
+    # superoptimizer.
+    superoptimizer = Superoptimizer(SAGE_OPERATIONS) if superoptimize else None
+    # Keeps the success rates of the mutation operators, and picks the
+    # operator of every child from them if they are adaptive.
+    # Without adaptive operators, the structural mutations keep their
+    # default mix, and are counted together.
+    scheduler = OperatorScheduler(MUTATION_OPERATORS if adaptive_operators else [POINT_MUTATION, STRUCTURAL_MIX], adaptive_operators)
+    # The parents are traced for the surrogate, and to weight the mutation
+    # sites of their children by how hot and how redundant they are.
+    profiled = hot_weight > 0.0 or redundant_weight > 0.0
+    traces = {}
+    os.makedirs(output_dir, exist_ok=True)
+    # Genomes are evaluated in sandboxed worker processes when there is more
+    # than one worker, or the sandbox is asked for. By default, a single
+    # worker evaluates in this process.
+    if sandbox is None:
+        sandbox = workers > 1
+    pool = None
+    if sandbox or workers > 1:
+        pool = SharedPopulation(max(workers, 1), fitness_function, SAGE_OPERATIONS, time_limit, memory_limit)
     try:
-        for epoch in range(epochs):
+        print("Sorting genomes...")
+        evaluate_genomes(genomes, pool, static_filter)
+        genomes.sort()
+        genomes = genomes[::-1]
+        print("Printing fitnesses...")
+        print(list(map(lambda g: g.fitness(), genomes)))
+        # Whether the best genome was superoptimized after the last epoch,
+        # so the final pass would only repeat it.
+        superoptimized = False
+        for epoch in range(first_epoch, epochs):
             print(f"Epoch {epoch}")
+            epoch_start = time()
 
-            genomes = genomes[:POPULATION_SIZE//10]
-            del genomes[POPULATION_SIZE//10:]
+            genomes = genomes[:survivors]
+            GENE_STORE.retain(genomes)
 
             print("Fitnesses:", list(map(lambda g: g.fitness(), genomes)))
+            if surrogate_filter is not None or profiled:
+                traces = trace_parents(genomes, traces, pool)
+            if surrogate_filter is not None:
+                surrogate_filter.traces = traces
             
             print("Mutating...")
             # Mutate the genomes.
-            for genome in genomes:
-                if len(genomes) < POPULATION_SIZE:
+            parents = list(genomes)
+            for genome in parents:
+                profile = None
+                if profiled and genome.id in traces:
+                    profile = SiteProfile(traces[genome.id], hot_weight, redundant_weight)
+                if len(genomes) < population_size:
                     for _ in range(10):
                         new_genome = genome.copy()
-                        new_genome.mutate(0.01)
+                        new_genome.mutate(0.01, operator=scheduler.choose(), profile=profile)
                         genomes.append(new_genome)
 
             # Sort the genomes by fitness.
             print("Sorting genomes...")
+            evaluate_genomes(genomes, pool, static_filter, surrogate_filter)
+            scheduler.record(parents, genomes[len(parents):])
             genomes.sort()
             genomes = genomes[::-1]
 
             print('Saving to file...')
-            with open(f'output/{epoch}.txt', 'w') as f:
+            with open(os.path.join(output_dir, f'{epoch}.txt'), 'w') as f:
                 f.write(str(genomes[0].into_operations()))
                 f.write('\n')
                 f.write('Fitness: ' + str(genomes[0].fitness()))
                 f.write('\n')
                 f.write('Program size: ' + str(genomes[0].get_size()))
                 f.write('\n')
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, epoch + 1, genomes[:survivors])
 
             print('Program size:', genomes[0].get_size())
+            if static_filter is not None:
+                print('Pre-filter:', static_filter)
+            if surrogate_filter is not None:
+                print('Surrogate:', surrogate_filter)
+            print('Operators:', scheduler)
+            if pool is not None and pool.faults > 0:
+                print('Evaluation faults:', pool.faults)
+            superoptimized = superoptimizer is not None and (epoch + 1) % superoptimize == 0
+            if superoptimized:
+                genomes[0] = superoptimize_genome(superoptimizer, genomes[0], fitness_function)
+            print(f'Epoch time: {time() - epoch_start:.2f}s')
+            if time_budget is not None and time() - start_time >= time_budget:
+                print('Time budget exhausted.')
+                break
+        if superoptimizer is not None and not superoptimized:
+            genomes[0] = superoptimize_genome(superoptimizer, genomes[0], fitness_function)
     except KeyboardInterrupt:
         pass
     finally:
+        if pool is not None:
+            pool.close()
         new_genome_size = genomes[0].get_size()
 
     return genomes[0].into_operations(), old_genome_size, new_genome_size 
@@ -0,0 +1,80 @@
+import argparse
+from evolve_sage_optimize import evolve_optimizations, parse, Genome, SAGE_OPERATIONS, POPULATION_SIZE, TIME_LIMIT, MEMORY_LIMIT
+from program_spec import load_spec
+
+# Optimize any compiled sage program against a test spec, for example:
+#
+#     python3 optimize.py factorial.vm.sg factorial.spec.json --epochs 300 --output factorial.py
+#
+# See program_spec.py for the format of the test spec.
+
+def write_program(path, ops):
+    with open(path, 'w') as f:
+        f.write(f'''from sage import *
+import sys
+
+program = {ops}
+
+tm = SageVirtualMachine(program, [int(arg) for arg in sys.argv[1:]])
+tape = Tape()
+tm.run(tape, 10000000000000000000)
+print(tm.output)
+''')
+
+def main():
+    parser = argparse.ArgumentParser(description='Evolve a smaller version of a sage VM program that still passes its test spec.')
+    parser.add_argument('program', help='the .vm.sg program to optimize')
+    parser.add_argument('spec', help='the JSON test spec the program must pass')
+    parser.add_argument('--population', type=int, default=POPULATION_SIZE, help='number of genomes per generation')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes used for evaluation')
+    parser.add_argument('--epochs', type=int, default=200, help='number of generations to run')
+    parser.add_argument('--time-budget', type=float, default=None, help='stop after this many seconds')
+    parser.add_argument('--checkpoint', default=None, help='save the population here every epoch, and resume from it if it exists')
+    parser.add_argument('--runtime-weight', type=float, default=0.0, help='cost of one executed test step, in instructions (0 optimizes size only)')
+    parser.add_argument('--superoptimize', type=int, default=0, help='run the windowed superoptimizer on the best genome every N epochs and at the end (0 disables it)')
+    parser.add_argument('--surrogate', action='store_true', help='skip children a learned model is confident are broken')
+    parser.add_argument('--exploration', type=float, default=0.1, help='fraction of the children the surrogate would skip that are run anyway')
+    parser.add_argument('--adaptive-operators', action='store_true', help='shift the mix of mutation operators towards the ones that currently improve programs')
+    parser.add_argument('--hot-weight', type=float, default=0.0, help='extra weight of the most executed genes when picking mutation sites')
+    parser.add_argument('--redundant-weight', type=float, default=0.0, help='extra weight of genes in runs of moves and dereferences when picking mutation sites')
+    parser.add_argument('--time-limit', type=float, default=TIME_LIMIT, help='seconds of CPU time one evaluation may use before it counts as a fault')
+    parser.add_argument('--memory-limit', type=int, default=MEMORY_LIMIT >> 20, help='megabytes of memory one evaluation may allocate before it counts as a fault')
+    parser.add_argument('--no-sandbox', action='store_true', help='evaluate in this process when there is only one worker, without any limits')
+    parser.add_argument('--output-dir', default='output', help='directory for the best program of every epoch')
+    parser.add_argument('--output', default=None, help='write the optimized program to this Python file')
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    original = Genome.from_operations(parse(open(args.program).read())[0], SAGE_OPERATIONS)
+    if spec(original) == 0.0:
+        parser.error(f"'{args.program}' does not pass its own test spec '{args.spec}'")
+
+    ops, old_genome_size, new_genome_size = evolve_optimizations(
+        args.program,
+        spec,
+        epochs=args.epochs,
+        population_size=args.population,
+        workers=args.workers,
+        time_budget=args.time_budget,
+        checkpoint=args.checkpoint,
+        output_dir=args.output_dir,
+        runtime_weight=args.runtime_weight,
+        superoptimize=args.superoptimize,
+        sandbox=not args.no_sandbox,
+        time_limit=args.time_limit,
+        memory_limit=args.memory_limit << 20,
+        surrogate=args.surrogate,
+        exploration=args.exploration,
+        adaptive_operators=args.adaptive_operators,
+        hot_weight=args.hot_weight,
+        redundant_weight=args.redundant_weight,
+    )
+    print(ops)
+    print(old_genome_size, new_genome_size)
+    print('Steps:', spec.run(original.into_operations()), spec.run(ops))
+    if args.output is not None:
+        print('Creating program from genome...')
+        write_program(args.output, ops)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import json
+from evolve_sage_optimize import SageVirtualMachine, Tape, program_cost, SANDBOX
+
+# A test spec describes the behaviour a program must keep while it is being
+# optimized. It is a JSON file that looks like so:
+#
+# {
+#     "max_steps": 5000,
+#     "cases": [
+#         {"input": [0], "output": [1]},
+#         {"input": [5], "output": [120], "max_steps": 20000}
+#     ]
+# }
+#
+# Every case feeds its input vector to the program and compares the output
+# against the expected output. Cases without their own step limit use the
+# top level "max_steps".
+DEFAULT_MAX_STEPS = 10000
+
+class SpecCase:
+    def __init__(self, input, output, max_steps=DEFAULT_MAX_STEPS):
+        self.input = list(input)
+        self.output = list(output)
+        self.max_steps = max_steps
+
+    def __repr__(self):
+        return f"SpecCase({self.input}, {self.output}, {self.max_steps})"
+
+class ProgramSpec:
+    def __init__(self, cases):
+        self.cases = cases
+        # Lets the static pre-filter reject programs that never print.
+        self.requires_output = any(len(case.output) > 0 for case in cases)
+
+    def __call__(self, genome, runtime_weight=0.0):
+        # This is the fitness function compiled from the spec. The genome is
+        # decoded only once, and the same operations are run against every
+        # case. The first failing case ends the evaluation.
+        try:
+            operations = genome.into_operations()
+        except MemoryError:
+            # A fault of the sandbox, which scores it, see `SANDBOX`.
+            if SANDBOX['active']:
+                raise
+            return 0.0
+        except Exception:
+            return 0.0
+
+        steps = self.run(operations)
+        if steps is None:
+            return 0.0
+        return len(self.cases) / program_cost(genome, steps, runtime_weight)
+
+    def run(self, operations):
+        # Returns the total number of steps executed across the cases, or
+        # None if any case fails.
+        steps = 0
+        for case in self.cases:
+            tm = SageVirtualMachine(operations, list(case.input))
+            try:
+                tm.run(Tape(), steps=case.max_steps)
+            except MemoryError:
+                if SANDBOX['active']:
+                    raise
+                return None
+            except Exception:
+                return None
+            if tm.output != case.output:
+                return None
+            steps += tm.steps
+        return steps
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __repr__(self):
+        return f"ProgramSpec({self.cases})"
+
+def load_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+
+    max_steps = spec.get('max_steps', DEFAULT_MAX_STEPS)
+    cases = []
+    for case in spec['cases']:
+        cases.append(SpecCase(case.get('input', []), case['output'], case.get('max_steps', max_steps)))
+    if len(cases) == 0:
+        raise ValueError(f"Test spec '{path}' has no cases")
+    return ProgramSpec(cases)
@@ -0,0 +1,72 @@
+import numpy as np
+
+# The genetic algorithms draw a few random numbers for every gene they build
+# or mutate. Drawing them one at a time from the `random` module costs more
+# than the work they are used for, so a RandomStream draws them in bulk from
+# a numpy Generator instead, and hands them out from a buffer.
+#
+# Worker processes only evaluate genomes and draw nothing, so a run can be
+# reproduced from the seed of the main process however the work is split
+# between workers. Streams are made at import time, and seeded by the
+# script that runs, see `seed`.
+BLOCK_SIZE = 1 << 16
+
+class RandomStream:
+    def __init__(self, sequence, block_size=BLOCK_SIZE):
+        # `sequence` is the numpy SeedSequence the stream is drawn from.
+        self.block_size = block_size
+        self.restart(sequence)
+
+    def from_seed(seed=None):
+        # With no seed, the stream is seeded from the OS.
+        return RandomStream(np.random.SeedSequence(seed))
+
+    def seed(self, seed=None):
+        # Restarts the stream from a seed, in place, since functions take
+        # the stream as a default argument. With no seed, it is seeded from
+        # the OS, and the seed it used is printed so the run can be repeated.
+        sequence = np.random.SeedSequence(seed)
+        if seed is None:
+            print(f"Random seed: {sequence.entropy}")
+        self.restart(sequence)
+
+    def restart(self, sequence):
+        self.sequence = sequence
+        self.generator = np.random.default_rng(sequence)
+        self.buffer = iter(())
+
+    def random(self):
+        value = next(self.buffer, None)
+        if value is None:
+            self.buffer = iter(self.generator.random(self.block_size).tolist())
+            value = next(self.buffer)
+        return value
+
+    def randint(self, low, high):
+        # Like `random.randint`, both ends are included.
+        return low + int(self.random() * (high - low + 1))
+
+    def choice(self, sequence):
+        return sequence[int(self.random() * len(sequence))]
+
+    def integers(self, low, high, count):
+        # `count` integers between `low` and `high`, both included.
+        return self.generator.integers(low, high + 1, count).tolist()
+
+    def uniform(self, high, count):
+        # `count` floats between 0 and `high`.
+        return (self.generator.random(count) * high).tolist()
+
+    def hits(self, count, rate):
+        # The indices of `count` trials that succeed with the given rate.
+        return np.flatnonzero(self.generator.random(count) < rate).tolist()
+
+    def first_hit(self, count, rate):
+        # The index of the first of `count` trials that succeeds with the
+        # given rate, or None if they all fail.
+        if rate >= 1:
+            return 0 if count > 0 else None
+        index = int(self.generator.geometric(rate)) - 1
+        if index >= count:
+            return None
+        return index
@@ -0,0 +1,127 @@
+import argparse
+import json
+from combinator import Genome, TERMS, Reducer, combinator_set
+
+# An enumeration database holds the smallest postfix genome for every
+# behaviour of the small genomes over a combinator set. It is a JSON file
+# that looks like so:
+#
+# {
+#     "combinators": ["S()", "K()", "I()", ...],
+#     "size": 9,
+#     "genomes": {"1 0 6": [1, 0, 6], ...}
+# }
+#
+# The behaviour of a genome is its normal form, written as a postfix
+# genome: the index of a combinator of the set, the repr of any other leaf,
+# and "A" for an application. Genomes that do not reach a normal form
+# within the step limit have no behaviour, and are left out.
+
+# Normal forms longer than this, as postfix genomes, are left out.
+MAX_SIGNATURE = 64
+# Marks where an application goes while a signature is written.
+APPLICATION = object()
+
+def enumerate_genomes(combinator_count, max_size):
+    # Every well formed postfix genome of at most `max_size` genes over
+    # `combinator_count` combinators, as encoded genes, smallest first.
+    application = combinator_count
+    by_leaves = {}
+    for leaves in range(1, (max_size + 1) // 2 + 1):
+        if leaves == 1:
+            genomes = [[i] for i in range(combinator_count)]
+        else:
+            # A genome applies the genes on top of the stack to the ones
+            # below them.
+            genomes = []
+            for function_leaves in range(1, leaves):
+                for function in by_leaves[function_leaves]:
+                    for argument in by_leaves[leaves - function_leaves]:
+                        genomes.append(argument + function + [application])
+        by_leaves[leaves] = genomes
+        yield from genomes
+
+class SKIDatabase:
+    def __init__(self, combinator_set, genomes=None, size=0):
+        self.combinator_set = combinator_set
+        self.genomes = {} if genomes is None else genomes
+        self.size = size
+        # The index of every combinator of the set, by its interned leaf.
+        self.indices = {id(TERMS.leaf(combinator)): i for i, combinator in enumerate(combinator_set)}
+        self.leaves = [TERMS.leaf(combinator) for combinator in combinator_set]
+
+    def build(self, max_size, step_limit=1000):
+        # Reduces every genome of at most `max_size` genes, and keeps the
+        # first, so smallest, genome of every behaviour.
+        checked = 0
+        for genes in enumerate_genomes(len(self.combinator_set), max_size):
+            checked += 1
+            term = Genome.decode(genes, self.combinator_set).evaluate(step_limit)
+            if term is None:
+                continue
+            key = self.signature(term)
+            if key is not None and key not in self.genomes:
+                self.genomes[key] = genes
+        self.size = max(self.size, max_size)
+        return checked
+
+    def signature(self, term):
+        # The normal form as a postfix genome, or None if it is too long.
+        tokens = []
+        stack = [term]
+        while stack:
+            current = stack.pop()
+            if current is APPLICATION:
+                tokens.append('A')
+            elif current.args:
+                # f x is written as x f A.
+                stack.append(APPLICATION)
+                stack.append(current.with_args(current.args[:-1]))
+                stack.append(current.args[-1])
+            else:
+                index = self.indices.get(id(TERMS.leaf(current)))
+                tokens.append(repr(current) if index is None else str(index))
+            if len(tokens) > MAX_SIGNATURE:
+                return None
+        return ' '.join(tokens)
+
+    def smallest(self, term):
+        # The smallest genome known to reduce to the same normal form as the
+        # term, or None.
+        key = self.signature(term)
+        if key is None or key not in self.genomes:
+            return None
+        return Genome.decode(self.genomes[key], self.combinator_set)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'combinators': [repr(combinator) for combinator in self.combinator_set],
+                'size': self.size,
+                'genomes': self.genomes,
+            }, f)
+
+    def load(path, combinator_set):
+        with open(path) as f:
+            database = json.load(f)
+        if database['combinators'] != [repr(combinator) for combinator in combinator_set]:
+            raise ValueError(f"Database '{path}' was built over {database['combinators']}")
+        return SKIDatabase(combinator_set, database['genomes'], database['size'])
+
+    def __len__(self):
+        return len(self.genomes)
+
+def main():
+    parser = argparse.ArgumentParser(description='Enumerate the small combinator genomes and index the smallest genome of every normal form.')
+    parser.add_argument('output', help='the JSON database to write')
+    parser.add_argument('--size', type=int, default=9, help='the most genes of an enumerated genome')
+    parser.add_argument('--steps', type=int, default=1000, help='reduction steps a genome may take to reach its normal form')
+    args = parser.parse_args()
+
+    database = SKIDatabase(combinator_set)
+    checked = database.build(args.size, args.steps)
+    database.save(args.output)
+    print(f'{len(database)} normal forms from {checked} genomes of at most {args.size} genes')
+
+if __name__ == '__main__':
+    main()
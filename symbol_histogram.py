@@ -0,0 +1,36 @@
+from collections import Counter
+import numpy as np
+from scipy.special import entr
+
+# The entropy fitness of `turing.py` and `evolve_sage_create.py` treats the
+# cells of the tape, capped at CELL_CAP, as the weights of a distribution,
+# like `scipy.stats.entropy(tape)`. Programs are short, so building an array
+# from the whole tape after every run costs more than running them. A
+# SymbolHistogram counts the values on a tape as they are written instead,
+# so the entropy only depends on the number of distinct values.
+CELL_CAP = 2.0 ** 16
+
+class SymbolHistogram:
+    def __init__(self, cells=()):
+        self.counts = Counter(cells)
+
+    def write(self, old, new):
+        # A cell holding `old` now holds `new`.
+        if old == new:
+            return
+        self.counts[old] -= 1
+        if self.counts[old] <= 0:
+            del self.counts[old]
+        self.counts[new] += 1
+
+    def extend(self, value, count):
+        # `count` new cells holding `value`.
+        if count > 0:
+            self.counts[value] += count
+
+    def entropy(self):
+        # The same as `scipy.stats.entropy` over every cell of the tape.
+        values = np.array([min(value, CELL_CAP) for value in self.counts], dtype=float)
+        counts = np.array(list(self.counts.values()), dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sum(counts * entr(values / np.sum(values * counts)))
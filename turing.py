@@ -1,22 +1,31 @@
-import random
 from copy import deepcopy
+from functools import partial
 import numpy as np
-from scipy.stats import entropy
+from random_stream import RandomStream
+from symbol_histogram import SymbolHistogram
+from evolution import Evolution, breed, report_best
+
+# Set this to repeat a run.
+SEED = None
+RNG = RandomStream.from_seed(SEED)
 
 class Tape:
-    def __init__(self, length=1000, blank_symbol=0, head_position=0, max_steps=1000):
+    def __init__(self, length=1000, blank_symbol=0, head_position=0, max_steps=1000, histogram=False):
         self.tape = [blank_symbol] * length
         self.head_position = head_position
         self.register = self.blank_symbol = blank_symbol
         self.max_steps = max_steps
         self.steps = 0
         self.env = {}
+        # With a histogram, the values on the tape are counted as they are
+        # written, and `entropy` does not have to read the tape.
+        self.histogram = SymbolHistogram(self.tape) if histogram else None
     
     def __getitem__(self, index):
         # Check if index is out of bounds
         if index >= len(self.tape):
             # If so, fill with blank symbols
-            self.tape += [self.blank_symbol] * (index - len(self.tape) + 1)
+            self.grow(index - len(self.tape) + 1)
         elif index < 0:
             return self.blank_symbol
         return self.tape[index]
@@ -25,11 +34,23 @@ class Tape:
         # Check if index is out of bounds
         if index >= len(self.tape):
             # If so, fill with blank symbols
-            self.tape += [self.blank_symbol] * (index - len(self.tape) + 1)
+            self.grow(index - len(self.tape) + 1)
         elif index < 0:
             return
+        if self.histogram is not None:
+            self.histogram.write(self.tape[index], value)
         self.tape[index] = value
 
+    def grow(self, count):
+        self.tape += [self.blank_symbol] * count
+        if self.histogram is not None:
+            self.histogram.extend(self.blank_symbol, count)
+
+    def entropy(self):
+        # The entropy of the cells of the tape as weights, see `SymbolHistogram`.
+        histogram = self.histogram if self.histogram is not None else SymbolHistogram(self.tape)
+        return histogram.entropy()
+
     def add_env(self, key, value):
         self.env[key] = value
     
@@ -332,79 +353,80 @@ class Genome:
                 total += 1
         return total
 
-    def random(operations, length=100):
-        genome, _ = gen_random_genome(length)
+    def random(operations, length=100, rng=RNG):
+        genome, _ = gen_random_genome(length, rng=rng)
         return Genome(operations, genome)
 
     def get_operation(self, index):
         return self.operations[index]
     
-    def mutate(self, mutation_rate):
-        for i in range(len(self.genome)):
-            if random.random() < mutation_rate:
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).mutate(mutation_rate).genome)
-                else:
-                    self.genome[i] = random.randint(0, len(self.operations) - 1)
+    def mutate(self, mutation_rate, rng=RNG):
+        # The genes to mutate are picked with one draw for the whole block.
+        for i in rng.hits(len(self.genome), mutation_rate):
+            if type(self.genome[i]) == list:
+                self.genome[i] = list(Genome(self.operations, self.genome[i]).mutate(mutation_rate, rng).genome)
+            else:
+                self.genome[i] = rng.randint(0, len(self.operations) - 1)
 
-        if random.random() < 0.5:
-            x = random.random()
+        if rng.random() < 0.5:
+            x = rng.random()
             if x < 0.3333:
-                self.insert_random_gene()
+                self.insert_random_gene(rng)
             elif x < 0.6666:
-                self.swap_random_gene()
+                self.swap_random_gene(rng)
             else:
-                self.remove_random_gene()
+                self.remove_random_gene(rng)
 
         return self
         
-    def crossover(self, other):
+    def crossover(self, other, rng=RNG):
         # Randomly select a crossover point.
-        index = random.randint(0, min(len(self.genome) - 1, len(other.genome) - 1))
+        index = rng.randint(0, min(len(self.genome) - 1, len(other.genome) - 1))
         # Create two new genomes by swapping the genes after the crossover point.
         return Genome(self.operations, self.genome[:index] + other.genome[index:]), Genome(self.operations, other.genome[:index] + self.genome[index:])
 
-    def crossover_splits(self, other):
+    def crossover_splits(self, other, rng=RNG):
         result = []
         for a, b in zip(self.genome, other.genome):
             if type(a) == list and type(b) == list:
-                result.append(Genome(self.operations, a).crossover_splits(Genome(self.operations, b)).genome)
+                result.append(Genome(self.operations, a).crossover_splits(Genome(self.operations, b), rng).genome)
             else:
-                if random.random() < 0.5:
+                if rng.random() < 0.5:
                     result.append(a)
                 else:
                     result.append(b)
         return Genome(self.operations, result)
 
-    def remove_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).remove_random_gene().genome)
-                else:
-                    del self.genome[i]
-                return self
+    def remove_random_gene(self, rng=RNG):
+        if len(self.genome) == 0:
+            return self
+        i = rng.first_hit(len(self.genome), 2 / len(self.genome))
+        if i is not None:
+            if type(self.genome[i]) == list:
+                self.genome[i] = list(Genome(self.operations, self.genome[i]).remove_random_gene(rng).genome)
+            else:
+                del self.genome[i]
         return self
     
-    def insert_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).insert_random_gene().genome)
-                else:
-                    self.genome.insert(i, random.randint(0, len(self.operations) - 1))
-                return self
-        self.genome.append(random.randint(0, len(self.operations) - 1))
+    def insert_random_gene(self, rng=RNG):
+        i = rng.first_hit(len(self.genome), 2 / len(self.genome)) if len(self.genome) > 0 else None
+        if i is None:
+            self.genome.append(rng.randint(0, len(self.operations) - 1))
+        elif type(self.genome[i]) == list:
+            self.genome[i] = list(Genome(self.operations, self.genome[i]).insert_random_gene(rng).genome)
+        else:
+            self.genome.insert(i, rng.randint(0, len(self.operations) - 1))
         return self
     
-    def swap_random_gene(self):
-        for i in range(len(self.genome)):
-            if random.random() < 2 / len(self.genome):
-                if type(self.genome[i]) == list:
-                    self.genome[i] = list(Genome(self.operations, self.genome[i]).swap_random_gene().genome)
-                else:
-                    self.genome[i] = random.randint(0, len(self.operations) - 1)
-                return self
+    def swap_random_gene(self, rng=RNG):
+        if len(self.genome) == 0:
+            return self
+        i = rng.first_hit(len(self.genome), 2 / len(self.genome))
+        if i is not None:
+            if type(self.genome[i]) == list:
+                self.genome[i] = list(Genome(self.operations, self.genome[i]).swap_random_gene(rng).genome)
+            else:
+                self.genome[i] = rng.randint(0, len(self.operations) - 1)
         return self
 
     def into_operations(self):
@@ -446,7 +468,7 @@ class Genome:
         # The fitness is the number of 1s in the tape.
         # return result.tape.count(1)
         try:
-            result = entropy(np.array(list(map(lambda x: min(x, 2.0 ** 16), result.tape)))).sum()
+            result = result.entropy()
             if np.isnan(result):
                 return 0.0
         except:
@@ -455,7 +477,7 @@ class Genome:
         return result * 1000 / self.get_size()
         
     def evaluate(self):
-        tape = Tape()
+        tape = Tape(histogram=True)
         tm = TuringMachine(self.into_operations())
         tm.run(tape, 3000)
         return tape
@@ -522,7 +544,7 @@ operations = [
     Arithmetic(Arithmetic.MODULO),
 ]
 
-def gen_random_genome(length=100, depth=0, max_depth=5):
+def gen_random_genome(length=100, depth=0, max_depth=5, rng=RNG):
     if depth > 7:
         return [], 0
     total = 0
@@ -531,18 +553,33 @@ def gen_random_genome(length=100, depth=0, max_depth=5):
         if total >= length:
             return genome, total
         
-        genome.append(random.randint(0, len(operations) - 1))
+        genome.append(rng.randint(0, len(operations) - 1))
         total += 1
 
         if total >= length:
             return genome, total
 
-        if random.random() < 0.5:
-            gene, partial = gen_random_genome(length, depth + 1)
+        if rng.random() < 0.5:
+            gene, partial = gen_random_genome(length, depth + 1, rng=rng)
             genome.append(gene)
             total += partial
     return genome, total
 
+def random_population(count, min_length, max_length, rng=RNG):
+    # All the genome lengths of a population are drawn at once.
+    return [Genome.random(operations, length, rng) for length in rng.integers(min_length, max_length, count)]
+
+def mutate_population(genomes, max_rate=0.5, rng=RNG):
+    # Returns mutated copies of about half of the genomes. Which genomes are
+    # copied and their mutation rates are drawn at once for the population.
+    picked = rng.hits(len(genomes), 0.5)
+    children = []
+    for i, rate in zip(picked, rng.uniform(max_rate, len(picked))):
+        child = deepcopy(genomes[i])
+        child.mutate(rate, rng)
+        children.append(child)
+    return children
+
 
 # genome = Genome.random(operations, 25)
 # print(genome)
@@ -562,50 +599,26 @@ def gen_random_genome(length=100, depth=0, max_depth=5):
 
 GENOME_SIZE = 100
 POPULATION_SIZE = 500
+# The number of processes that evaluate genomes. With more than one, they
+# are evaluated over a pool, for example of `os.cpu_count()` processes.
+WORKERS = 1
 # combinator_set = [S(), K(), I(), Data(Point(0, 0)), Lambda(lambda point: Data(point.value.shift_by(1, 0))), Lambda(lambda point: Data(point.value.shift_by(0, 1)))]
-genomes = [Genome.random(operations, random.randint(GENOME_SIZE//3, GENOME_SIZE)) for _ in range(POPULATION_SIZE)]
-genomes.sort()
-genomes = genomes[::-1]
-print(list(map(lambda g: g.fitness(), genomes)))
-try:
-    for epoch in range(200):
-        print(f"Epoch {epoch}")
-
-        best_genomes = genomes[:POPULATION_SIZE//10]
-
-        print(list(map(lambda g: g.fitness(), best_genomes)))
-        # Create the next generation.
-        # The first 10 genomes are the best genomes from the previous generation.
-        genomes = deepcopy(best_genomes) + [Genome.random(operations, random.randint(GENOME_SIZE//3, GENOME_SIZE)) for _ in range(POPULATION_SIZE - len(best_genomes))]
-
-        # Cross over the best genomes.
-        for i in range(0, len(best_genomes), 2):
-            child1, child2 = best_genomes[i].crossover(best_genomes[i + 1])
-            genomes.append(child1)
-            genomes.append(child2)
-
-        # Cross over the best genomes.
-        for i in range(0, len(best_genomes), 2):
-            child = best_genomes[i].crossover_splits(best_genomes[i + 1])
-            genomes.append(child)
-        
-        # Mutate the genomes.
-        for genome in genomes:
-            if random.random() < 0.5:
-                new_genome = deepcopy(genome)
-                new_genome.mutate(random.random() * 0.5)
-                genomes.append(new_genome)
-
-        genomes.extend(best_genomes)
-        # Sort the genomes by fitness.
-        genomes.sort()
-        genomes = genomes[::-1]
-
-        # print(list(map(lambda g: g.fitness(), genomes)))
-        print(genomes[0].into_operations())
-        print(genomes[0].evaluate())
-except KeyboardInterrupt:
-    genomes = best_genomes
+
+if __name__ == '__main__':
+    RNG.seed(SEED)
+    evolution = Evolution(
+        POPULATION_SIZE,
+        lambda count: random_population(count, GENOME_SIZE//3, GENOME_SIZE),
+        partial(breed, mutate_population=mutate_population),
+        fitness=Genome.fitness,
+        workers=WORKERS,
+        encode=lambda genome: genome.genome,
+        decode=partial(Genome, operations),
+        report=report_best,
+    )
+    genomes, scores = evolution.run(200)
+    evolution.close()
+    print(scores)
 
 # tm = TuringMachine(genome.into_operations())
 # tape = Tape()